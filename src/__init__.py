@@ -1,7 +1,2 @@
-from . import bot
-from . import log
-from . import personas
-from . import responses
-from .art import image_generation, video_generation, model_3d, utils
-from .commands import chat, draw, imagine, model_3d, reset, help, music
-from .ui import draw_buttons, aspect_ratio_view, generate_video_view
\ No newline at end of file
+# Submodules are imported where they're used rather than here, so image worker processes can import
+# src.art.image_workers without loading the bot
@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import functools
+from collections import deque
+from src import metrics
+from .error_handler import display_error, handle_error, is_client_error, ContentModerationError, INVALID_REQUEST_PREFIX
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Outcomes of the last WINDOW calls decide whether a provider is healthy
+WINDOW = int(os.getenv("CIRCUIT_WINDOW", 20))
+MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", 5))
+FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", 0.5))
+# Calls slower than this count as failures even if they succeed
+SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", 90))
+# How long an open breaker rejects calls before letting a single trial call through
+OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+
+MODERATION_MESSAGE = handle_error(ContentModerationError())
+
+class CircuitOpenError(Exception):
+    pass
+
+def is_provider_failure(result):
+    # Generators return error messages instead of raising; a moderation rejection or a rejected (4xx) request
+    # means the provider is working, and rerouting either to another provider would be wrong
+    return isinstance(result, str) and result != MODERATION_MESSAGE and not result.startswith(INVALID_REQUEST_PREFIX)
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=WINDOW)
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.latency = None
+        self.rejected = 0
+
+    def available(self):
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= OPEN_SECONDS
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight
+        return True
+
+    def before_call(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= OPEN_SECONDS:
+            self.state = HALF_OPEN
+            logger.info(f"Circuit for {self.name} is half open, sending a trial call")
+        if self.state == OPEN or (self.state == HALF_OPEN and self.trial_in_flight):
+            self.rejected += 1
+            raise CircuitOpenError(f"{self.name} is temporarily unavailable")
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = True
+
+    def record(self, failed, duration):
+        self.latency = duration if self.latency is None else 0.8 * self.latency + 0.2 * duration
+        failed = failed or duration > SLOW_CALL_SECONDS
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = False
+            if failed:
+                self.open()
+            else:
+                self.close()
+            return
+
+        self.outcomes.append(failed)
+        if self.state == CLOSED and len(self.outcomes) >= MIN_CALLS and sum(self.outcomes) / len(self.outcomes) >= FAILURE_RATE:
+            self.open()
+
+    def cancel_trial(self):
+        if self.state == HALF_OPEN:
+            self.trial_in_flight = False
+
+    def open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        logger.warning(f"Circuit for {self.name} opened, rejecting calls for {OPEN_SECONDS:.0f}s")
+
+    def close(self):
+        self.state = CLOSED
+        self.outcomes.clear()
+        logger.info(f"Circuit for {self.name} closed")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failure_rate": sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0,
+            "latency": self.latency,
+            "rejected": self.rejected,
+        }
+
+breakers = {}
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+metrics.gauge("bonk_circuit_state", "Provider circuit state (0 closed, 1 half open, 2 open)", ("provider",),
+              lambda: {(name,): STATE_VALUES[breaker.state] for name, breaker in breakers.items()})
+
+def get_breaker(name):
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+def circuit_breaker(name):
+    # Wraps a generator that returns an error message on failure; an open circuit returns one straight away
+    def decorator(func):
+        breaker = get_breaker(name)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                breaker.before_call()
+            except CircuitOpenError as e:
+                return display_error(e)
+
+            started = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                breaker.record(not is_client_error(e), time.monotonic() - started)
+                raise
+            except BaseException:
+                # Cancelled, which says nothing about the provider's health
+                breaker.cancel_trial()
+                raise
+            breaker.record(is_provider_failure(result), time.monotonic() - started)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+import inspect
+import logging
+import functools
+from collections import defaultdict
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    # Identical calls made while one is already running share that call's result instead of starting another
+    def __init__(self):
+        self.inflight = {}
+        self.calls = defaultdict(int)
+        self.saved = defaultdict(int)
+
+    async def run(self, name, key, func, *args, **kwargs):
+        key = (name, key)
+        task = self.inflight.get(key)
+        if task is None:
+            self.calls[name] += 1
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.saved[name] += 1
+            logger.debug(f"Joined in-flight {name} call ({self.saved[name]} saved so far)")
+        # One caller giving up mustn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            name: {
+                "calls": self.calls[name],
+                "saved": self.saved[name],
+                "in_flight": sum(1 for key in self.inflight if key[0] == name),
+            }
+            for name in self.calls
+        }
+
+single_flight = SingleFlight()
+metrics.counter("bonk_coalesced_calls_saved_total", "Generation calls answered by an identical call already in flight", ("name",),
+                lambda: {(name,): saved for name, saved in single_flight.saved.items()})
+
+def call_key(arguments):
+    return tuple(arguments.items())
+
+def image_key(arguments):
+    # Key image inputs on their content hash rather than holding the bytes in the key
+    return arguments["digest"] or hashlib.sha256(arguments["image_data"]).hexdigest()
+
+def coalesce(name, key=call_key):
+    # Keys are built from the bound arguments with defaults filled in, so f(a) and f(a, seed=None) match
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return await single_flight.run(name, key(bound.arguments), func, *args, **kwargs)
+        return wrapper
+    return decorator
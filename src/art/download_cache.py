@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import mimetypes
+from urllib.parse import urlparse
+from collections import OrderedDict
+from src import metrics
+from src.cache import PersistentCache
+from src.http_client import http_client
+from .media_store import media_store
+
+logger = logging.getLogger(__name__)
+
+# Responses up to this size are kept in memory, larger ones go to the media store if it persists downloads.
+# When it doesn't, everything stays in memory within MEMORY_MAX_BYTES
+MEMORY_ITEM_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MEMORY_ITEM_BYTES", 256 * 1024))
+MEMORY_MAX_BYTES = int(os.getenv("DOWNLOAD_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+# Entries younger than this are served without asking the server again
+FRESH_TTL = int(os.getenv("DOWNLOAD_CACHE_FRESH_TTL", 300))
+# How long a disk entry is kept around for conditional revalidation
+ENTRY_TTL = 24 * 3600
+
+def file_extension(url, content_type):
+    # Prefer the Content-Type, then the extension in the URL (Discord attachment URLs keep it), then a generic one
+    extension = None
+    mime_type = (content_type or "").split(";")[0].strip().lower()
+    if mime_type and mime_type != "application/octet-stream":
+        extension = mimetypes.guess_extension(mime_type)
+    if not extension:
+        extension = os.path.splitext(urlparse(url).path)[1]
+    extension = extension.lstrip(".").lower()
+    if not extension.isalnum() or len(extension) > 5:
+        return "bin"
+    return extension
+
+class DownloadCache:
+    def __init__(self):
+        # url -> (data, digest, etag, last_modified, fetched_at)
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.index = PersistentCache("downloads", ttl=ENTRY_TTL)
+        self.inflight = {}
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    async def get(self, url):
+        # Returns (data, sha256 digest); concurrent fetches of the same URL share a single request
+        task = self.inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._get(url))
+            self.inflight[url] = task
+            task.add_done_callback(lambda _: self.inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, url):
+        entry = self.memory.get(url)
+        if entry is not None:
+            self.memory.move_to_end(url)
+            return entry
+
+        raw = await self.index.get(url)
+        if raw is None:
+            return None
+        meta = json.loads(raw)
+        try:
+            data = await media_store.read(meta["path"])
+        except FileNotFoundError:
+            # The media store evicted the file
+            return None
+        return data, meta["digest"], meta.get("etag"), meta.get("last_modified"), meta["fetched_at"]
+
+    async def _get(self, url):
+        cached = await self._lookup(url)
+        headers = {}
+        if cached is not None:
+            data, digest, etag, last_modified, fetched_at = cached
+            if time.time() - fetched_at < FRESH_TTL:
+                self.hits += 1
+                return data, digest
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        resp = await http_client.get_hashed(url, headers=headers)
+        if resp.status_code == 304 and cached is not None:
+            self.revalidated += 1
+            await self._store(url, data, digest, etag, last_modified, resp.headers.get("Content-Type"))
+            return data, digest
+        if resp.status_code != 200:
+            raise Exception(f"HTTP error status: {resp.status_code}")
+
+        self.misses += 1
+        await self._store(url, resp.content, resp.digest, resp.headers.get("ETag"), resp.headers.get("Last-Modified"),
+                          resp.headers.get("Content-Type"))
+        return resp.content, resp.digest
+
+    async def _store(self, url, data, digest, etag, last_modified, content_type=None):
+        fetched_at = time.time()
+        if len(data) <= MEMORY_ITEM_MAX_BYTES or not media_store.should_persist("download"):
+            if len(data) > MEMORY_MAX_BYTES:
+                return
+            previous = self.memory.pop(url, None)
+            if previous is not None:
+                self.memory_bytes -= len(previous[0])
+            self.memory[url] = (data, digest, etag, last_modified, fetched_at)
+            self.memory_bytes += len(data)
+            while self.memory_bytes > MEMORY_MAX_BYTES and self.memory:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted[0])
+            return
+
+        path = await media_store.put(data, file_extension(url, content_type), kind="download", digest=digest)
+        await self.index.set(url, json.dumps({
+            "path": path,
+            "digest": digest,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": fetched_at,
+        }))
+
+    def stats(self):
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.revalidated) / lookups if lookups else 0.0,
+            "memory_bytes": self.memory_bytes,
+        }
+
+download_cache = DownloadCache()
+metrics.track_cache("downloads", lambda: (download_cache.hits + download_cache.revalidated, download_cache.misses))
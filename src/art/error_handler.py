@@ -1,8 +1,19 @@
 class ContentModerationError(Exception):
     pass
 
+class ClientRequestError(Exception):
+    # The provider turned down this particular request (a 4xx), which says nothing about its health
+    pass
+
 import traceback
 
+INVALID_REQUEST_PREFIX = "Invalid request:"
+
+def is_client_error(error):
+    # 4xx from the provider, except timeouts and rate limits which are about the provider rather than the request
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
 def handle_error(error):
     error_type = type(error).__name__
     error_message = str(error)
@@ -11,8 +22,8 @@ def handle_error(error):
         return "There was an issue connecting to the AI service. Please check your internet connection and try again."
     elif error_type == "APIError":
         return f"An error occurred with the AI service: {error_message}"
-    elif error_type == "InvalidRequestError":
-        return f"Invalid request: {error_message}"
+    elif error_type in ("InvalidRequestError", "BadRequestError", "ClientRequestError"):
+        return f"{INVALID_REQUEST_PREFIX} {error_message}"
     elif error_type == "AuthenticationError":
         return "Authentication failed. Please check your API key and try again."
     elif error_type == "RateLimitError":
@@ -21,6 +32,10 @@ def handle_error(error):
         return "Invalid API key. Please check your API key and try again."
     elif error_type == "ContentModerationError":
         return "Your request was flagged by the content moderation system and cannot be processed"
+    elif error_type == "CircuitOpenError":
+        return "This model is temporarily unavailable after repeated failures. Please try another model or try again shortly."
+    elif is_client_error(error):
+        return f"{INVALID_REQUEST_PREFIX} {error_message}"
     else:
         return f"An unexpected error occurred (Or content moderation was triggered)"
 
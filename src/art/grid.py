@@ -0,0 +1,16 @@
+import asyncio
+import logging
+from . import image_workers
+from .image_processing import get_executor
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 512
+
+async def compose_grid(images, labels, columns=None, tile_size=TILE_SIZE):
+    # Returns PNG bytes with each image letterboxed into a labelled tile
+    if not images:
+        raise ValueError("No images to compose")
+    columns = columns or min(len(images), 3)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), image_workers.compose_grid, list(images), list(labels), columns, tile_size)
@@ -1,121 +1,142 @@
 import os
-import requests
 import io
+import random
+import asyncio
+import aiohttp
 from PIL import Image
 import replicate
 import logging
-import hashlib
-from openai import OpenAI
+from openai import AsyncOpenAI, BadRequestError
 from dotenv import load_dotenv
-from .error_handler import display_error, ContentModerationError
+from src.http_client import http_client, form_data
+from src.rate_limiter import rate_limiter
+from .error_handler import display_error, ContentModerationError, ClientRequestError
+from .media_store import media_store
+from .coalesce import coalesce
+from .circuit_breaker import circuit_breaker, get_breaker, is_provider_failure
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries on 429 are left to the rate limiter so they queue behind the provider limit
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 stability_api_key = os.getenv("STABILITY_API_KEY")
 replicate_api_token = os.getenv("REPLICATE_API_TOKEN")
 
-IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'images')
-os.makedirs(IMAGES_DIR, exist_ok=True)
 def truncate_prompt(self, prompt, max_length=250):
     if len(prompt) <= max_length:
         return prompt
     return prompt[:max_length] + "..."
 
+@coalesce("dalle")
+@circuit_breaker("dalle")
 async def generate_image_dalle(prompt):
     try:
         logger.debug(f"Generating image with DALL-E 3. Prompt: {prompt}")
-        response = openai_client.images.generate(
+        response = await rate_limiter.call("openai/images", lambda: openai_client.images.generate(
             model="dall-e-3",
             prompt=prompt,
             size="1024x1024",
             quality="standard",
             n=1,
-        )
+        ))
         image_url = response.data[0].url
         logger.debug(f"DALL-E 3 image generated successfully. URL: {image_url}")
         
-        image_data = requests.get(image_url).content
-        image_hash = hashlib.md5(image_data).hexdigest()
-        image_filename = f"{image_hash}.png"
-        image_path = os.path.join(IMAGES_DIR, image_filename)
-        
-        with open(image_path, "wb") as file:
-            file.write(image_data)
-        
+        image_data = (await http_client.get(image_url)).content
+        image_path = await media_store.put(image_data, "png", kind="image", provider="dalle", prompt=prompt)
+
         return image_data, image_path
+    except BadRequestError as e:
+        if getattr(e, "code", None) == "content_policy_violation":
+            logger.error(f"Content moderation error: {str(e)}")
+            return display_error(ContentModerationError("The image was flagged by content moderation."))
+        logger.error(f"DALL-E 3 rejected the request: {str(e)}")
+        return display_error(e)
     except Exception as e:
         logger.error(f"Error generating image from DALL-E 3: {str(e)}")
         return display_error(e)
 
-async def generate_image_sd(prompt, aspect_ratio):
+@coalesce("sd")
+@circuit_breaker("sd")
+async def generate_image_sd(prompt, aspect_ratio, seed=None):
     try:
         logger.debug(f"Generating image with Stable Diffusion 3. Prompt: {prompt}, Aspect Ratio: {aspect_ratio}")
-        
-        response = requests.post(
+
+        data = {
+            "prompt": prompt,
+            "aspect_ratio": aspect_ratio,
+            "output_format": "png"
+        }
+        if seed is not None:
+            data["seed"] = seed
+
+        response = await rate_limiter.call("stability/image", lambda: http_client.post(
             "https://api.stability.ai/v2beta/stable-image/generate/sd3",
             headers={
                 "Authorization": f"Bearer {stability_api_key}",
                 "Accept": "image/*"
             },
-            files={
-                "none": ""
-            },
-            data={
-                "prompt": prompt,
-                "aspect_ratio": aspect_ratio,
-                "output_format": "png"
-            }
-        )
+            data=form_data(
+                files={
+                    "none": ""
+                },
+                data=data
+            )
+        ))
 
         if response.status_code == 200:
             logger.debug("Stable Diffusion 3 image generated successfully")
             image_data = response.content
-            image_hash = hashlib.md5(image_data).hexdigest()
-            image_filename = f"{image_hash}.png"
-            image_path = os.path.join(IMAGES_DIR, image_filename)
-            
-            with open(image_path, "wb") as file:
-                file.write(image_data)
-            
+            image_path = await media_store.put(image_data, "png", kind="image", provider="sd3", prompt=prompt)
+
             return image_data, image_path
         elif response.status_code == 400:
             error_data = response.json()
             if 'message' in error_data and 'content moderation' in error_data['message'].lower():
                 raise ContentModerationError("The image was flagged by content moderation.")
             else:
-                raise Exception(f"Bad Request: {error_data.get('message', 'Unknown error')}")
+                raise ClientRequestError(f"Bad Request: {error_data.get('message', 'Unknown error')}")
+        elif 400 < response.status_code < 500 and response.status_code not in (408, 429):
+            raise ClientRequestError(f"Error: {response.status_code} {response.text}")
         else:
             raise Exception(f"Error: {response.status_code} {response.text}")
 
     except ContentModerationError as e:
         logger.error(f"Content moderation error: {str(e)}")
         return display_error(e)
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"Network error when generating image from Stability AI: {str(e)}")
         return display_error(e)
     except Exception as e:
         logger.error(f"Error generating image from Stability AI: {str(e)}")
         return display_error(e)
 
-async def generate_image_replicate(prompt, aspect_ratio):
+@coalesce("replicate")
+@circuit_breaker("replicate")
+async def generate_image_replicate(prompt, aspect_ratio, seed=None):
     try:
         logger.debug(f"Generating image with Replicate (black-forest-labs/flux-schnell). Prompt: {prompt}, Aspect Ratio: {aspect_ratio}")
-        
-        prediction = replicate.run(
+
+        model_input = {
+            "prompt": prompt,
+            "aspect_ratio": aspect_ratio,
+            "steps": 25,
+            "guidance": 3,
+            "interval": 2,
+            "output_format": "webp",
+            "output_quality": 100,
+            "disable_safety_checker": True,
+        }
+        if seed is not None:
+            model_input["seed"] = seed
+
+        # The replicate client is synchronous, so keep it off the event loop
+        prediction = await rate_limiter.call("replicate", lambda: asyncio.to_thread(
+            replicate.run,
             "black-forest-labs/flux-schnell",
-            input={
-                "prompt": prompt,
-                "aspect_ratio": aspect_ratio,
-                "steps": 25,
-                "guidance": 3,
-                "interval": 2,
-                "output_format": "webp",
-                "output_quality": 100,
-                "disable_safety_checker": True,
-            }
-        )
+            input=model_input
+        ))
 
         if isinstance(prediction, list) and len(prediction) > 0:
             output_url = prediction[0]
@@ -131,14 +152,9 @@ async def generate_image_replicate(prompt, aspect_ratio):
 
         logger.debug(f"Replicate image generated successfully. URL: {output_url}")
         
-        image_data = requests.get(output_url).content
-        image_hash = hashlib.md5(image_data).hexdigest()
-        image_filename = f"{image_hash}.webp"
-        image_path = os.path.join(IMAGES_DIR, image_filename)
-        
-        with open(image_path, "wb") as file:
-            file.write(image_data)
-        
+        image_data = (await http_client.get(output_url)).content
+        image_path = await media_store.put(image_data, "webp", kind="image", provider="replicate", prompt=prompt)
+
         return image_data, image_path
 
     except ContentModerationError as e:
@@ -147,9 +163,123 @@ async def generate_image_replicate(prompt, aspect_ratio):
     except replicate.exceptions.ReplicateError as e:
         logger.error(f"Replicate API error: {str(e)}")
         return display_error(e)
-    except requests.RequestException as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"Network error when generating image from Replicate: {str(e)}")
         return display_error(e)
     except Exception as e:
         logger.error(f"Error generating image from Replicate: {str(e)}")
-        return display_error(e)
\ No newline at end of file
+        return display_error(e)
+
+# Seconds to wait for providers in a comparison before sending whatever has arrived
+COMPARE_DEADLINE = float(os.getenv("COMPARE_DEADLINE", 90))
+
+async def _generate_dalle_any_ratio(prompt, aspect_ratio):
+    # DALL-E 3 is always generated square
+    return await generate_image_dalle(prompt)
+
+COMPARE_PROVIDERS = {
+    "Dall-E 3": _generate_dalle_any_ratio,
+    "Stable Diffusion 3": generate_image_sd,
+    "Replicate": generate_image_replicate,
+}
+
+async def generate_comparison(prompt, aspect_ratio="1:1", deadline=COMPARE_DEADLINE):
+    # Runs every provider at once; returns [(model_name, image_data)] and {model_name: error message}
+    tasks = {
+        name: asyncio.ensure_future(generate(prompt, aspect_ratio))
+        for name, generate in COMPARE_PROVIDERS.items()
+    }
+    done, pending = await asyncio.wait(tasks.values(), timeout=deadline)
+    for task in pending:
+        task.cancel()
+
+    results = []
+    errors = {}
+    for name, task in tasks.items():
+        if task not in done:
+            errors[name] = "Timed out"
+        elif task.exception() is not None:
+            errors[name] = display_error(task.exception())
+        elif isinstance(task.result(), str):
+            errors[name] = task.result()
+        else:
+            results.append((name, task.result()[0]))
+    return results, errors
+
+IMAGE_PROVIDERS = {
+    "dalle": ("Dall-E 3", _generate_dalle_any_ratio),
+    "sd": ("Stable Diffusion 3", generate_image_sd),
+    "replicate": ("Replicate", generate_image_replicate),
+}
+# Order the other providers are tried in when one fails or is too slow
+FAILOVER_ORDER = ["sd", "replicate", "dalle"]
+# Reroute a failed /draw to the next healthy provider
+FAILOVER = os.getenv("IMAGE_FAILOVER", "False").lower() == "true"
+# Start the next healthy provider alongside a request that hasn't answered after this many seconds
+HEDGE_AFTER = float(os.getenv("IMAGE_HEDGE_AFTER", 0)) or None
+
+def fallback_providers(model):
+    return [name for name in FAILOVER_ORDER if name != model and get_breaker(name).available()]
+
+async def generate_image(model, prompt, aspect_ratio="1:1", failover=FAILOVER, hedge_after=HEDGE_AFTER):
+    # Returns (provider, result) where result is (image_data, image_path) or an error message
+    candidates = [model] + (fallback_providers(model) if failover or hedge_after else [])
+    pending = {}
+    first_error = None
+
+    def start(name):
+        generate = IMAGE_PROVIDERS[name][1]
+        pending[asyncio.ensure_future(generate(prompt, aspect_ratio))] = name
+
+    start(candidates.pop(0))
+    try:
+        while pending:
+            timeout = hedge_after if hedge_after and candidates else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info(f"Hedging slow {', '.join(pending.values())} request with {candidates[0]}")
+                start(candidates.pop(0))
+                continue
+
+            for task in done:
+                name = pending.pop(task)
+                result = task.result()
+                if not is_provider_failure(result):
+                    return name, result
+                logger.warning(f"{name} failed: {result}")
+                first_error = first_error or (name, result)
+
+            if not pending and candidates and failover:
+                logger.info(f"Failing over to {candidates[0]}")
+                start(candidates.pop(0))
+        return first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+MAX_VARIANTS = 4
+# How many variant requests each provider may have in flight at once, across all users
+VARIANT_CONCURRENCY = {
+    "sd": int(os.getenv("SD_VARIANT_CONCURRENCY", 2)),
+    "replicate": int(os.getenv("REPLICATE_VARIANT_CONCURRENCY", 4)),
+}
+VARIANT_GENERATORS = {
+    "sd": generate_image_sd,
+    "replicate": generate_image_replicate,
+}
+_variant_semaphores = {}
+
+async def generate_variants(model, prompt, aspect_ratio, count):
+    # Returns one result per variant, each either (image_data, image_path) or an error message
+    generate = VARIANT_GENERATORS[model]
+    semaphore = _variant_semaphores.get(model)
+    if semaphore is None:
+        semaphore = _variant_semaphores[model] = asyncio.Semaphore(VARIANT_CONCURRENCY[model])
+
+    async def generate_one(seed):
+        async with semaphore:
+            return await generate(prompt, aspect_ratio, seed=seed)
+
+    # Distinct seeds so the variants actually differ
+    seeds = random.sample(range(1, 2**31), min(count, MAX_VARIANTS))
+    return await asyncio.gather(*(generate_one(seed) for seed in seeds))
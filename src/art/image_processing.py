@@ -0,0 +1,48 @@
+import os
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from src import metrics
+from src.cache import LRUCache
+from .image_workers import preprocess, VIDEO_TARGET, MODEL_3D_TARGET
+
+logger = logging.getLogger(__name__)
+
+# Decoding and resizing is CPU bound, so it runs in worker processes instead of on the event loop
+PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", 2))
+_executor = None
+
+# Preprocessed outputs keyed on (source hash, target), bounded by their total size as well as their number
+preprocess_cache = LRUCache(int(os.getenv("IMAGE_PREPROCESS_CACHE_SIZE", 64)),
+                            max_bytes=int(os.getenv("IMAGE_PREPROCESS_CACHE_BYTES", 64 * 1024 * 1024)))
+metrics.track_cache("image_preprocess", lambda: (preprocess_cache.hits, preprocess_cache.misses))
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # Forked workers start with image_workers already loaded. Where fork isn't available (Windows) they spawn,
+        # which only imports image_workers since it doesn't depend on the rest of the bot
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork") if "fork" in methods else None
+        _executor = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=context)
+    return _executor
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def preprocess_image(image_data, target, digest=None):
+    key = (digest or hashlib.sha256(image_data).hexdigest(), target)
+    cached = preprocess_cache.get(key)
+    if cached is not None:
+        logger.debug(f"Using cached {target} preprocessing for {key[0]}")
+        return cached
+
+    loop = asyncio.get_running_loop()
+    processed = await loop.run_in_executor(get_executor(), preprocess, image_data, target)
+    preprocess_cache.set(key, processed)
+    return processed
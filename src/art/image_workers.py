@@ -0,0 +1,82 @@
+import io
+import math
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Runs in the image worker processes. Keep this module down to PIL and NumPy so a spawned worker
+# only has to import this, not the bot.
+
+VIDEO_TARGET = "video"
+MODEL_3D_TARGET = "3d"
+MODEL_3D_MAX_SIDE = 1024
+
+LABEL_HEIGHT = 40
+BACKGROUND = (32, 34, 37)
+LABEL_COLOR = (255, 255, 255)
+
+def video_size(width, height):
+    aspect_ratio = width / height
+    if aspect_ratio > 1:
+        return (1024, 576)
+    elif aspect_ratio < 1:
+        return (576, 1024)
+    return (768, 768)
+
+def preprocess(image_data, target):
+    with Image.open(io.BytesIO(image_data)) as img:
+        if target == VIDEO_TARGET:
+            new_size = video_size(img.width, img.height)
+            # Let the JPEG decoder scale down while decoding instead of decoding full size
+            img.draft('RGB', new_size)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img = img.resize(new_size, Image.LANCZOS)
+        elif target == MODEL_3D_TARGET:
+            # Keep transparency, it helps the model separate the foreground
+            img.draft('RGB', (MODEL_3D_MAX_SIDE, MODEL_3D_MAX_SIDE))
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            if max(img.size) > MODEL_3D_MAX_SIDE:
+                img.thumbnail((MODEL_3D_MAX_SIDE, MODEL_3D_MAX_SIDE), Image.LANCZOS)
+        else:
+            raise ValueError(f"Unknown preprocessing target: {target}")
+
+        output = io.BytesIO()
+        img.save(output, format='PNG')
+        return output.getvalue()
+
+def _load_font():
+    try:
+        return ImageFont.load_default(size=24)
+    except TypeError:
+        # Pillow < 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+def compose_grid(images, labels, columns, tile_size):
+    rows = math.ceil(len(images) / columns)
+    cell_height = tile_size + LABEL_HEIGHT
+    canvas = np.empty((rows * cell_height, columns * tile_size, 3), dtype=np.uint8)
+    canvas[:] = BACKGROUND
+
+    for index, image_data in enumerate(images):
+        with Image.open(io.BytesIO(image_data)) as img:
+            img.draft('RGB', (tile_size, tile_size))
+            img = img.convert('RGB')
+            img.thumbnail((tile_size, tile_size), Image.LANCZOS)
+            tile = np.asarray(img)
+        row, column = divmod(index, columns)
+        height, width = tile.shape[:2]
+        top = row * cell_height + LABEL_HEIGHT + (tile_size - height) // 2
+        left = column * tile_size + (tile_size - width) // 2
+        canvas[top:top + height, left:left + width] = tile
+
+    grid = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(grid)
+    font = _load_font()
+    for index, label in enumerate(labels):
+        row, column = divmod(index, columns)
+        draw.text((column * tile_size + 10, row * cell_height + 8), label, fill=LABEL_COLOR, font=font)
+
+    output = io.BytesIO()
+    grid.save(output, format='PNG')
+    return output.getvalue()
@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'images')
+MAX_BYTES = int(os.getenv("MEDIA_STORE_MAX_BYTES", 2 * 1024 * 1024 * 1024))  # 2 GiB
+# Kinds of media written to disk; everything else only ever lives in memory
+PERSIST_KINDS = set(os.getenv("MEDIA_STORE_PERSIST_KINDS", "image,video,model").split(","))
+EVICT_INTERVAL = int(os.getenv("MEDIA_STORE_EVICT_INTERVAL", 600))
+
+class MediaStore:
+    def __init__(self, root=IMAGES_DIR, max_bytes=MAX_BYTES, persist_kinds=PERSIST_KINDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.persist_kinds = persist_kinds
+        self.index_path = os.path.join(root, "media.sqlite3")
+        self._db = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                "digest TEXT PRIMARY KEY, path TEXT NOT NULL, kind TEXT NOT NULL, provider TEXT, prompt TEXT, "
+                "size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS media_last_access ON media (last_access)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS media_path ON media (path)")
+        return self._db
+
+    def path_for(self, digest, ext):
+        # Two levels of sharding keep each directory small
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{ext}")
+
+    def should_persist(self, kind):
+        return kind in self.persist_kinds
+
+    def _put(self, data, ext, kind, provider, prompt, digest):
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        # Checked and written under the lock so eviction can't remove the file between the check and the upsert
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT path FROM media WHERE digest = ?", (digest,)).fetchone()
+            if row is not None and os.path.exists(row[0]):
+                # Keep one file per digest, even if it was first stored under another extension
+                db.execute("UPDATE media SET last_access = ? WHERE digest = ?", (now, digest))
+                db.commit()
+                return row[0]
+
+            path = self.path_for(digest, ext)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(temp_path, "wb") as file:
+                    file.write(data)
+                os.replace(temp_path, path)
+            db.execute(
+                "INSERT INTO media (digest, path, kind, provider, prompt, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(digest) DO UPDATE SET last_access = excluded.last_access, path = excluded.path",
+                (digest, path, kind, provider, prompt, len(data), now, now)
+            )
+            db.commit()
+        return path
+
+    async def put(self, data, ext, kind, provider=None, prompt=None, digest=None):
+        # Returns the stored path, or None when this kind of media isn't kept on disk
+        if not self.should_persist(kind):
+            return None
+        path = await asyncio.to_thread(self._put, data, ext, kind, provider, prompt, digest)
+        logger.debug(f"Stored {kind} ({len(data)} bytes) at {path}")
+        return path
+
+    def _touch(self, path):
+        with self._lock:
+            db = self._connect()
+            db.execute("UPDATE media SET last_access = ? WHERE path = ?", (time.time(), path))
+            db.commit()
+
+    async def touch(self, path):
+        await asyncio.to_thread(self._touch, path)
+
+    def _read(self, path):
+        with open(path, "rb") as file:
+            data = file.read()
+        self._touch(path)
+        return data
+
+    async def read(self, path):
+        # Reads stored media back, marking it as used so the evictor removes the least recently used files first.
+        # Raises FileNotFoundError if it has been evicted
+        return await asyncio.to_thread(self._read, path)
+
+    def _evict(self):
+        with self._lock:
+            db = self._connect()
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM media").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            evicted = 0
+            rows = db.execute("SELECT digest, path, size FROM media ORDER BY last_access").fetchall()
+            for digest, path, size in rows:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"Error evicting {path}: {str(e)}")
+                    continue
+                db.execute("DELETE FROM media WHERE digest = ?", (digest,))
+                total -= size
+                evicted += 1
+            db.commit()
+            return evicted
+
+    async def evict(self):
+        evicted = await asyncio.to_thread(self._evict)
+        if evicted:
+            logger.info(f"Evicted {evicted} files from the media store")
+        return evicted
+
+    async def _run_evictor(self):
+        while True:
+            try:
+                await self.evict()
+            except Exception as e:
+                logger.error(f"Error running media store eviction: {str(e)}")
+            await asyncio.sleep(EVICT_INTERVAL)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run_evictor())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+media_store = MediaStore()
@@ -1,14 +1,18 @@
 import os
-import requests
+import io
 import discord
 from src import log
 from src.art import utils
+from src.http_client import http_client, form_data
+from src.rate_limiter import rate_limiter
 from .error_handler import display_error
+from .media_store import media_store
+from .coalesce import coalesce, image_key
+from .image_processing import preprocess_image, MODEL_3D_TARGET
 
 logger = log.setup_logger(__name__)
 
 stability_api_key = os.getenv("STABILITY_API_KEY")
-IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'images')
 
 class ContentModerationError(Exception):
     pass
@@ -36,9 +40,9 @@ async def handle_3d(interaction: discord.Interaction, user: discord.Member = Non
             image_url = user.avatar.url if user.avatar else user.default_avatar.url
         
         if image_url:
-            image_path = await utils.download_image_from_url(image_url)
-            model_path = await generate_3d_model(image_path)
-            file = discord.File(model_path, filename="3d_model.glb")
+            image_data, image_digest = await utils.download_image_from_url(image_url)
+            model_data = await generate_3d_model(image_data, image_digest)
+            file = discord.File(io.BytesIO(model_data), filename="3d_model.glb")
             await interaction.followup.send(content="Here's your generated 3D model:", file=file)
         else:
             await interaction.followup.send("Please provide a user, attach an image, or reply to a message with an image to generate a 3D model.")
@@ -48,18 +52,21 @@ async def handle_3d(interaction: discord.Interaction, user: discord.Member = Non
         error_message = display_error(e)
         await interaction.followup.send(content=error_message)
 
-async def generate_3d_model(image_path):
+@coalesce("3d", key=image_key)
+async def generate_3d_model(image_data, digest=None):
     try:
-        logger.debug(f"Generating 3D model from image: {image_path}")
-        
-        with open(image_path, "rb") as image_file:
-            response = requests.post(
-                "https://api.stability.ai/v2beta/3d/stable-fast-3d",
-                headers={
-                    "Authorization": f"Bearer {stability_api_key}",
-                },
+        logger.debug(f"Generating 3D model from image: {len(image_data)} bytes")
+
+        image_data = await preprocess_image(image_data, MODEL_3D_TARGET, digest)
+
+        response = await rate_limiter.call("stability/3d", lambda: http_client.post(
+            "https://api.stability.ai/v2beta/3d/stable-fast-3d",
+            headers={
+                "Authorization": f"Bearer {stability_api_key}",
+            },
+            data=form_data(
                 files={
-                    "image": image_file
+                    "image": ("image.png", image_data, "image/png")
                 },
                 data={
                     "texture_resolution": "1024",
@@ -67,6 +74,7 @@ async def generate_3d_model(image_path):
                     "remesh": "none"
                 }
             )
+        ))
 
         if response.status_code == 403:
             error_data = response.json()
@@ -79,10 +87,8 @@ async def generate_3d_model(image_path):
 
         logger.debug("3D model generated successfully")
         model_data = response.content
-        model_path = os.path.join(IMAGES_DIR, os.path.basename(image_path).replace(".png", ".glb"))
-        with open(model_path, "wb") as model_file:
-            model_file.write(model_data)
-        return model_path
+        await media_store.put(model_data, "glb", kind="model", provider="stability")
+        return model_data
 
     except Exception as e:
         logger.error(f"Error generating 3D model: {str(e)}")
@@ -1,26 +1,15 @@
-import os
-import aiohttp
 import logging
-import time
+from .download_cache import download_cache
 
 logger = logging.getLogger(__name__)
 
-IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'images')
-
 async def download_image_from_url(url):
+    # Returns (image_data, sha256 digest) without writing anything to disk
     try:
         logger.debug(f"Downloading image from URL: {url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    raise Exception(f"HTTP error status: {resp.status}")
-                image_data = await resp.read()
-                
-        temp_path = os.path.join(IMAGES_DIR, f"temp_image_{int(time.time())}.png")
-        with open(temp_path, "wb") as file:
-            file.write(image_data)
-        logger.debug(f"Image downloaded and saved to: {temp_path}")
-        return temp_path
+        image_data, image_digest = await download_cache.get(url)
+        logger.debug(f"Image downloaded: {len(image_data)} bytes")
+        return image_data, image_digest
     except Exception as e:
         logger.error(f"Error downloading image from URL: {str(e)}")
         raise
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import time
+import asyncio
+import logging
+from src.http_client import http_client
+from src.rate_limiter import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+stability_api_key = os.getenv("STABILITY_API_KEY")
+RESULT_URL = "https://api.stability.ai/v2beta/image-to-video/result/{}"
+
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 30
+# Jobs due within this window of each other are polled in the same sweep
+SWEEP_WINDOW = 2.5
+# Starting guess for how long a render takes, refined from observed completions
+INITIAL_EXPECTED_DURATION = 60
+MAX_JOB_DURATION = 600
+MAX_POLL_ERRORS = 3
+
+class VideoJob:
+    __slots__ = ("generation_id", "future", "submitted_at", "next_poll_at", "errors")
+
+    def __init__(self, generation_id, future, submitted_at, next_poll_at):
+        self.generation_id = generation_id
+        self.future = future
+        self.submitted_at = submitted_at
+        self.next_poll_at = next_poll_at
+        self.errors = 0
+
+class VideoPoller:
+    def __init__(self):
+        self.jobs = {}
+        self.expected_duration = INITIAL_EXPECTED_DURATION
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for job in self.jobs.values():
+            if not job.future.done():
+                job.future.cancel()
+        self.jobs.clear()
+
+    def submit(self, generation_id):
+        future = asyncio.get_running_loop().create_future()
+        now = time.monotonic()
+        first_poll = max(MIN_POLL_INTERVAL, self.expected_duration * 0.8)
+        self.jobs[generation_id] = VideoJob(generation_id, future, now, now + first_poll)
+        self.start()
+        self._wakeup.set()
+        return future
+
+    async def wait(self, generation_id):
+        return await self.submit(generation_id)
+
+    def _next_interval(self, job, now):
+        remaining = job.submitted_at + self.expected_duration - now
+        if remaining > 0:
+            return min(max(remaining, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+        return min(max(self.expected_duration * 0.1, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+    def _record_completion(self, job, now):
+        observed = now - job.submitted_at
+        self.expected_duration = 0.8 * self.expected_duration + 0.2 * observed
+        logger.debug(f"Video {job.generation_id} finished in {observed:.1f}s, expecting {self.expected_duration:.1f}s")
+
+    def _finish(self, job, result=None, error=None):
+        self.jobs.pop(job.generation_id, None)
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def _run(self):
+        while True:
+            # Drop jobs whose callers have gone away
+            for job in [job for job in self.jobs.values() if job.future.done()]:
+                self.jobs.pop(job.generation_id, None)
+
+            if not self.jobs:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            next_due = min(job.next_poll_at for job in self.jobs.values())
+            if next_due > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_due - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = [job for job in self.jobs.values() if job.next_poll_at <= now + SWEEP_WINDOW]
+            logger.debug(f"Polling {len(due)} of {len(self.jobs)} video jobs")
+            await asyncio.gather(*(self._poll(job) for job in due))
+
+    async def _poll(self, job):
+        try:
+            response = await rate_limiter.call("stability/poll", lambda: http_client.get(
+                RESULT_URL.format(job.generation_id),
+                headers={
+                    "Authorization": f"Bearer {stability_api_key}",
+                    "Accept": "video/*"
+                }
+            ))
+        except Exception as e:
+            job.errors += 1
+            if job.errors >= MAX_POLL_ERRORS:
+                self._finish(job, error=e)
+            else:
+                job.next_poll_at = time.monotonic() + MIN_POLL_INTERVAL
+            return
+
+        now = time.monotonic()
+        if response.status_code == 202:
+            if now - job.submitted_at > MAX_JOB_DURATION:
+                self._finish(job, error=Exception(f"Video generation {job.generation_id} timed out"))
+            else:
+                job.next_poll_at = now + self._next_interval(job, now)
+        elif response.status_code == 200:
+            self._record_completion(job, now)
+            self._finish(job, result=response.content)
+        else:
+            self._finish(job, error=Exception(f"Error fetching video: {response.status_code} {response.text}"))
+
+video_poller = VideoPoller()
@@ -13,6 +13,11 @@ import asyncio
 import io
 import random
 from src.queue_manager import enqueue
+from src.http_client import http_client
+from src.art.video_poller import video_poller
+from src.art.media_store import media_store
+from src.art import image_processing
+from src.metrics import metrics_server
 
 load_dotenv()
 os.environ['SSL_CERT_FILE'] = certifi.where()
@@ -26,7 +31,24 @@ intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-client_instance = discord.Client(intents=intents)
+class BonkClient(discord.Client):
+    async def setup_hook(self):
+        await http_client.startup()
+        video_poller.start()
+        media_store.start()
+        music.sessions.start()
+        await metrics_server.start()
+
+    async def close(self):
+        await metrics_server.stop()
+        await music.sessions.stop()
+        await media_store.stop()
+        await video_poller.stop()
+        await http_client.shutdown()
+        image_processing.shutdown()
+        await super().close()
+
+client_instance = BonkClient(intents=intents)
 tree = app_commands.CommandTree(client_instance)
 
 @client_instance.event
@@ -53,15 +75,16 @@ async def chat_command(interaction: discord.Interaction, message: str):
 @tree.command(name="draw", description="Generate an image with the Dalle3, Stable Diffusion, or Replicate model")
 @app_commands.describe(
     prompt="The prompt for image generation",
-    enhance="Enhance the prompt using AI (optional)"
+    enhance="Enhance the prompt using AI (optional)",
+    variants="How many variants to generate with Stable Diffusion or Replicate, shown as one grid (optional)"
 )
 @app_commands.choices(enhance=[
     app_commands.Choice(name="Yes", value="yes"),
     app_commands.Choice(name="No", value="no")
 ])
 @enqueue
-async def draw_command(interaction: discord.Interaction, prompt: str, enhance: app_commands.Choice[str] = None):
-    await draw.handle_draw(interaction, prompt, enhance)
+async def draw_command(interaction: discord.Interaction, prompt: str, enhance: app_commands.Choice[str] = None, variants: app_commands.Range[int, 1, 4] = 1):
+    await draw.handle_draw(interaction, prompt, enhance, variants)
 
 @tree.command(name="imagine", description="Animate user profile pictures or an attached image")
 @enqueue
@@ -129,4 +152,5 @@ async def tts_command(interaction: discord.Interaction, text: str, voice: app_co
             
 def run_discord_bot():
     TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-    client_instance.run(TOKEN)
\ No newline at end of file
+    # Logging is already set up by src.log, so don't let discord.py add a second handler
+    client_instance.run(TOKEN, log_handler=None)
\ No newline at end of file
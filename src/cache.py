@@ -0,0 +1,168 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from src import log
+
+logger = log.setup_logger(__name__)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'cache')
+
+class LRUCache:
+    # max_bytes optionally bounds the total len() of the values as well as the number of entries
+    def __init__(self, max_entries, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return value
+            self.pop(key)
+        if count:
+            self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self.pop(key)
+        if self.max_bytes is not None:
+            if len(value) > self.max_bytes:
+                return
+            self.bytes += len(value)
+        self.entries[key] = (expires_at, value)
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        if self.max_bytes is not None:
+            self.bytes -= len(entry[1])
+        return entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+class PersistentCache:
+    # In-memory LRU in front of a SQLite table, for small text values worth keeping across restarts
+    def __init__(self, name, max_entries=10000, ttl=30 * 24 * 3600, memory_entries=1024):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory = LRUCache(memory_entries, ttl)
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        return self._db
+
+    def _get_disk(self, key):
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            now = time.time()
+            if self.ttl and created + self.ttl < now:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+            return value
+
+    def _set_disk(self, key, value):
+        with self._lock:
+            db = self._connect()
+            now = time.time()
+            db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._writes += 1
+            # Evict expired and least recently used rows every so often rather than on every write
+            if self._writes % 100 == 1:
+                if self.ttl:
+                    db.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+                db.execute(
+                    "DELETE FROM entries WHERE key IN ("
+                    "SELECT key FROM entries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            db.commit()
+
+    async def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        try:
+            value = await asyncio.to_thread(self._get_disk, key)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading {self.name} cache: {str(e)}")
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, value)
+        return value
+
+    async def set(self, key, value):
+        self.memory.set(key, value)
+        try:
+            await asyncio.to_thread(self._set_disk, key, value)
+        except sqlite3.Error as e:
+            logger.error(f"Error writing {self.name} cache: {str(e)}")
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
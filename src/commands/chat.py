@@ -1,20 +1,77 @@
+import os
+import time
 import uuid
 from src import responses, log
 
 logger = log.setup_logger(__name__)
 
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "True") == "True"
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+# Minimum seconds between edits of the same message, to stay under Discord's edit rate limit
+EDIT_INTERVAL = 1.2
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    # Prefer breaking on a newline, then a space, so words aren't cut in half
+    cut = text.rfind("\n", 0, limit)
+    if cut <= 0:
+        cut = text.rfind(" ", 0, limit)
+    if cut <= 0:
+        cut = limit
+    return text[:cut], text[cut:].lstrip()
+
+async def stream_to_followup(interaction, message, conversation_id=None):
+    sent = await interaction.followup.send("...", wait=True)
+    text = ""
+    shown = ""
+    received = False
+    last_edit = time.monotonic()
+
+    async def show(content):
+        # After a split the next message is only posted once there is something to put in it
+        nonlocal sent, shown, last_edit
+        if sent is None:
+            sent = await interaction.followup.send(content, wait=True)
+        else:
+            await sent.edit(content=content)
+        shown = content
+        last_edit = time.monotonic()
+
+    async for chunk in responses.stream_response(message, conversation_id):
+        received = received or bool(chunk)
+        text += chunk
+        while len(text) > MESSAGE_LIMIT:
+            head, text = split_message(text)
+            await show(head)
+            sent = None
+            shown = ""
+        if text.strip() and text != shown and time.monotonic() - last_edit >= EDIT_INTERVAL:
+            await show(text)
+
+    if not received:
+        await show("I couldn't come up with a response.")
+    elif text.strip() and text != shown:
+        await show(text)
+
 async def handle_chat(interaction, message):
     message_id = str(uuid.uuid4())[:8]
+    log.request_id.set(message_id)
     logger.info(f"[{message_id}] Received chat command from {interaction.user} : /chat [{message}] in ({interaction.channel})")
-    
+
     try:
+        if CHAT_STREAMING:
+            logger.info(f"[{message_id}] Streaming response to user")
+            await stream_to_followup(interaction, message, interaction.channel_id)
+            logger.info(f"[{message_id}] Response streamed to user")
+            return
+
         logger.info(f"[{message_id}] Calling handle_response")
-        response = await responses.handle_response(message)
+        response = await responses.handle_response(message, interaction.channel_id)
         logger.info(f"[{message_id}] Received response from handle_response")
-        
+
         logger.info(f"[{message_id}] Sending response to user")
         await interaction.followup.send(response)
         logger.info(f"[{message_id}] Response sent to user")
     except Exception as e:
         logger.exception(f"[{message_id}] Error in chat command: {str(e)}")
-        await interaction.followup.send("An error occurred while processing your request.")
\ No newline at end of file
+        await interaction.followup.send("An error occurred while processing your request.")
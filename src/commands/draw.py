@@ -3,7 +3,7 @@ from src.ui.draw_buttons import DrawButtons
 
 logger = log.setup_logger(__name__)
 
-async def handle_draw(interaction, prompt, enhance=None):
+async def handle_draw(interaction, prompt, enhance=None, variants=1):
     username = str(interaction.user)
     channel = str(interaction.channel)
     logger.info(f"\x1b[31m{username}\x1b[0m : /draw [{prompt}] in ({channel})")
@@ -15,9 +15,9 @@ async def handle_draw(interaction, prompt, enhance=None):
             prompt = enhanced_prompt
             logger.info(f"Enhanced prompt: {prompt}")
 
-        view = DrawButtons(prompt, interaction)
+        view = DrawButtons(prompt, interaction, variants)
+        # The buttons handle generation themselves, so don't hold a queue worker while the user picks
         await interaction.followup.send(content="Select the model you want to use:", view=view)
-        await view.wait()
     except Exception as e:
         logger.exception(f"Error in draw command: {str(e)}")
         await interaction.followup.send("An error occurred while preparing image generation options.")
\ No newline at end of file
@@ -6,7 +6,7 @@ async def handle_help(interaction):
     await interaction.response.defer()
     await interaction.followup.send(""":star:**BASIC COMMANDS** \n
     - `/chat [message]` Chat with Claude!
-    - `/draw [prompt]` Generate an image with the Dalle3, Stable Diffusion, or Replicate model
+    - `/draw [prompt] [variants]` Generate an image with the Dalle3, Stable Diffusion, or Replicate model
     - `/imagine [user]` Animate a user's profile picture or an attached image
     - `/3d [user]` Generate a 3D model from a user's profile picture or an attached image
     - `/reset` Clear Claude conversation history
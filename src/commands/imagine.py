@@ -1,7 +1,9 @@
+import io
 import discord
 import random
 from src import log
 from src.art import video_generation, utils
+from src.queue_manager import queue_manager
 
 logger = log.setup_logger(__name__)
 
@@ -40,11 +42,20 @@ async def handle_imagine(interaction: discord.Interaction, user: discord.Member
 
         await interaction.followup.send("Processing your image... This may take a moment.")
 
-        image_path = await utils.download_image_from_url(image_url)
-        video_path = await video_generation.image_to_video(image_path)
-        file = discord.File(video_path, filename="animated.mp4")
-        await interaction.followup.send(content="Here's your animated image:", file=file)
+        image_data, image_digest = await utils.download_image_from_url(image_url)
+        generation_id = await video_generation.submit_image_to_video(image_data, image_digest)
+        # The render is polled in the background, so don't keep the video lane busy waiting for it
+        queue_manager.run_detached(deliver_video(interaction, generation_id))
+
+    except Exception as e:
+        logger.exception(f"Error in imagine command: {str(e)}")
+        await interaction.followup.send(content="An error occurred while processing the image.")
 
+async def deliver_video(interaction: discord.Interaction, generation_id):
+    try:
+        video_data = await video_generation.fetch_video(generation_id)
+        file = discord.File(io.BytesIO(video_data), filename="animated.mp4")
+        await interaction.followup.send(content="Here's your animated image:", file=file)
     except Exception as e:
         logger.exception(f"Error in imagine command: {str(e)}")
         await interaction.followup.send(content="An error occurred while processing the image.")
\ No newline at end of file
@@ -1,3 +1,4 @@
+import io
 import discord
 from src import log
 from src.art import model_3d, utils
@@ -35,9 +36,9 @@ async def handle_3d(interaction: discord.Interaction, user: discord.Member = Non
         # If we have an image URL, process it
         if image_url:
             await interaction.followup.send("Generating 3D model... This may take a moment.")
-            image_path = await utils.download_image_from_url(image_url)
-            model_path = await model_3d.generate_3d_model(image_path)
-            file = discord.File(model_path, filename="3d_model.glb")
+            image_data, image_digest = await utils.download_image_from_url(image_url)
+            model_data = await model_3d.generate_3d_model(image_data, image_digest)
+            file = discord.File(io.BytesIO(model_data), filename="3d_model.glb")
             await interaction.followup.send(content="Here's your generated 3D model:", file=file)
         else:
             await interaction.followup.send("Please provide a user, attach an image, or reply to a message with an image to generate a 3D model.")
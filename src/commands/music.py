@@ -3,141 +3,398 @@ from discord import app_commands
 import yt_dlp
 import asyncio
 import os
-import threading
-from src import log
+import time
+import contextlib
+from itertools import islice
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from src import log, metrics
+from src.cache import LRUCache
 from youtubesearchpython import VideosSearch
 
 logger = log.setup_logger(__name__)
 
+# Sessions with nothing playing for this long are disconnected and dropped
+IDLE_TIMEOUT = int(os.getenv("MUSIC_IDLE_TIMEOUT", 300))
+REAP_INTERVAL = 60
+MAX_QUEUE_LENGTH = int(os.getenv("MUSIC_MAX_QUEUE_LENGTH", 1000))
+# Number of upcoming songs resolved in the background while the current one plays
+PREFETCH_COUNT = int(os.getenv("MUSIC_PREFETCH_COUNT", 2))
+# Playback stops when this many songs in a row fail to resolve, e.g. when yt-dlp is broken
+MAX_CONSECUTIVE_FAILURES = int(os.getenv("MUSIC_MAX_CONSECUTIVE_FAILURES", 3))
+# Placeholder titles of playlist entries that can't be played
+UNAVAILABLE_TITLES = {"[Private video]", "[Deleted video]"}
+
+YDL_OPTS = {
+    # Opus streams (usually WebM) can go to Discord without being re-encoded
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
+    'quiet': True,
+}
+
+# Playlists are listed without resolving each entry; entries are resolved just before they play
+PLAYLIST_YDL_OPTS = {
+    **YDL_OPTS,
+    'extract_flat': 'in_playlist',
+}
+
+FFMPEG_OPTIONS = {
+    # FFmpeg reads the media URL directly, reconnecting if the stream drops
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
+    'options': '-vn'
+}
+
+# yt-dlp and search calls block, so they run on a small dedicated pool
+EXTRACT_WORKERS = int(os.getenv("MUSIC_EXTRACT_WORKERS", 4))
+extract_executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix="music-extract")
+
+SEARCH_CACHE_TTL = 24 * 3600
+# Stream URLs expire after a few hours, so resolved metadata is kept for less than that
+INFO_CACHE_TTL = int(os.getenv("MUSIC_INFO_CACHE_TTL", 3600))
+search_cache = LRUCache(4096, ttl=SEARCH_CACHE_TTL)
+info_cache = LRUCache(4096, ttl=INFO_CACHE_TTL)
+metrics.track_cache("music_search", lambda: (search_cache.hits, search_cache.misses))
+metrics.track_cache("music_info", lambda: (info_cache.hits, info_cache.misses))
+
+class Track:
+    __slots__ = ("url", "title", "resolving")
+
+    def __init__(self, url, title):
+        self.url = url
+        self.title = title
+        self.resolving = None
+
+def compact_info(info):
+    # Only keep what playback needs, full yt-dlp info dicts are large
+    return {'title': info['title'], 'url': info['url'], 'acodec': info.get('acodec')}
+
+def extract_info(url):
+    with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if 'entries' in info:
+        # This is a playlist or a list of videos
+        info = info['entries'][0]
+    return compact_info(info)
+
+def entry_url(entry):
+    url = entry.get('webpage_url') or entry.get('url')
+    if url and url.startswith(('http://', 'https://')):
+        return url
+    if entry.get('ie_key', 'Youtube') == 'Youtube' and entry.get('id'):
+        return f"https://www.youtube.com/watch?v={entry['id']}"
+    return url
+
+def extract_tracks(url):
+    # Returns (playlist title, tracks, info); info is only set for single videos
+    with yt_dlp.YoutubeDL(PLAYLIST_YDL_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if 'entries' not in info:
+        return None, [Track(url, info['title'])], compact_info(info)
+    tracks = []
+    for entry in info['entries']:
+        if not entry or entry.get('title') in UNAVAILABLE_TITLES:
+            continue
+        track_url = entry_url(entry)
+        if track_url:
+            tracks.append(Track(track_url, entry.get('title') or track_url))
+    return info.get('title') or url, tracks, None
+
+def search_video(query):
+    search_result = VideosSearch(query, limit=1).result()
+    if not search_result['result']:
+        return None
+    return search_result['result'][0]['link']
+
+def create_audio_source(info):
+    # Discord voice is Opus, so copy Opus streams as-is and only transcode other codecs once
+    if info.get('acodec') == 'opus':
+        return discord.FFmpegOpusAudio(info['url'], codec='copy', **FFMPEG_OPTIONS)
+    return discord.FFmpegOpusAudio(info['url'], **FFMPEG_OPTIONS)
+
+async def run_extractor(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(extract_executor, func, *args)
+
+async def get_info(url):
+    info = info_cache.get(url)
+    if info is None:
+        info = await run_extractor(extract_info, url)
+        info_cache.set(url, info)
+    return info
+
+async def get_tracks(url):
+    info = info_cache.get(url)
+    if info is not None:
+        return None, [Track(url, info['title'])]
+    playlist_title, tracks, info = await run_extractor(extract_tracks, url)
+    if info is not None:
+        info_cache.set(url, info)
+    return playlist_title, tracks
+
+async def search(query):
+    key = " ".join(query.split()).casefold()
+    url = search_cache.get(key)
+    if url is None:
+        url = await run_extractor(search_video, query)
+        if url is not None:
+            search_cache.set(key, url)
+    return url
+
 class MusicPlayer:
-    def __init__(self):
-        self.queue = []
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.queue = deque()
         self.current_song = None
         self.is_playing = False
         self.voice_client = None
-        self.ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'outtmpl': 'temp_audio.%(ext)s',
-        }
-        self.ffmpeg_options = {
-            'options': '-vn'
-        }
-
-    async def play_next(self, interaction):
-        if not self.queue:
-            await interaction.followup.send("Queue is empty. Disconnecting...")
-            if self.voice_client:
-                await self.voice_client.disconnect()
-            self.is_playing = False
-            self.voice_client = None
-            return
+        self.text_channel = None
+        self.loop = None
+        self.lock = asyncio.Lock()
+        self.last_active = time.monotonic()
 
-        self.current_song = self.queue.pop(0)
-        self.is_playing = True
+    def touch(self):
+        self.last_active = time.monotonic()
 
+    async def connect(self, channel):
         if not self.voice_client or not self.voice_client.is_connected():
-            self.voice_client = await interaction.user.voice.channel.connect()
+            self.voice_client = await channel.connect()
+        elif self.voice_client.channel != channel:
+            await self.voice_client.move_to(channel)
+
+    def prefetch(self):
+        for song in islice(self.queue, PREFETCH_COUNT):
+            if song.resolving is None:
+                song.resolving = asyncio.ensure_future(get_info(song.url))
 
+    def cancel_prefetch(self):
+        for song in islice(self.queue, PREFETCH_COUNT):
+            if song.resolving is not None:
+                song.resolving.cancel()
+                song.resolving = None
+
+    async def resolve(self, song):
+        task, song.resolving = song.resolving, None
+        if task is not None:
+            try:
+                return await task
+            except Exception as e:
+                logger.warning(f"Prefetch failed for {song.title}, retrying: {str(e)}")
+        return await get_info(song.url)
+
+    async def disconnect(self):
+        self.is_playing = False
+        self.cancel_prefetch()
+        self.queue.clear()
+        self.current_song = None
+        if self.voice_client:
+            voice_client, self.voice_client = self.voice_client, None
+            voice_client.stop()
+            await voice_client.disconnect()
+
+    async def send(self, content):
+        # Followup tokens expire after 15 minutes, so later updates go to the channel instead
         try:
-            # Download audio
-            with yt_dlp.YoutubeDL(self.ydl_opts) as ydl:
-                ydl.download([self.current_song['url']])
+            await self.text_channel.send(content)
+        except discord.DiscordException as e:
+            logger.error(f"Couldn't send music update in guild {self.guild_id}: {str(e)}")
 
-            # Play audio
-            audio_source = discord.FFmpegPCMAudio('temp_audio.mp3', **self.ffmpeg_options)
-            self.voice_client.play(audio_source, after=lambda e: asyncio.run_coroutine_threadsafe(self.song_finished(interaction), interaction.client.loop))
+    async def play_next(self):
+        # Songs that fail are skipped in this loop rather than by recursing, so a long run of failures can't blow the stack
+        failures = 0
+        while True:
+            self.touch()
+            if not self.queue:
+                await self.send("Queue is empty. Disconnecting...")
+                await self.disconnect()
+                return
 
-            await interaction.followup.send(f"Now playing: {self.current_song['title']}")
-            logger.info(f"Started playing: {self.current_song['title']}")
+            self.current_song = self.queue.popleft()
+            self.is_playing = True
 
-        except Exception as e:
-            logger.error(f"Error playing {self.current_song['title']}: {str(e)}")
-            await interaction.followup.send(f"An error occurred while playing {self.current_song['title']}: {str(e)}")
-            await self.song_finished(interaction)
+            try:
+                # Use the prefetched stream URL if there is one, otherwise resolve it off the event loop
+                info = await self.resolve(self.current_song)
+                if not self.voice_client or not self.voice_client.is_connected():
+                    # Stopped while the stream was being resolved
+                    return
+
+                # Play audio
+                audio_source = create_audio_source(info)
+                self.voice_client.play(audio_source, after=lambda e: asyncio.run_coroutine_threadsafe(self.song_finished(), self.loop))
+            except Exception as e:
+                self.is_playing = False
+                failures += 1
+                logger.error(f"Error playing {self.current_song.title}: {str(e)}")
+                if failures >= MAX_CONSECUTIVE_FAILURES:
+                    await self.send(f"Couldn't play the last {failures} songs ({str(e)}). Stopping playback.")
+                    await self.disconnect()
+                    return
+                if not self.voice_client or not self.voice_client.is_connected():
+                    return
+                continue
 
-    async def song_finished(self, interaction):
+            self.prefetch()
+
+            skipped = f" (skipped {failures} that couldn't be played)" if failures else ""
+            await self.send(f"Now playing: {self.current_song.title}{skipped}")
+            logger.info(f"Started playing in guild {self.guild_id}: {self.current_song.title}")
+            return
+
+    async def song_finished(self):
         self.is_playing = False
-        # Clean up temporary files
-        if os.path.exists('temp_audio.mp3'):
-            os.remove('temp_audio.mp3')
-        await self.play_next(interaction)
+        # The player was stopped or disconnected rather than reaching the end of a song
+        if not self.voice_client or not self.voice_client.is_connected():
+            return
+        await self.play_next()
+
+class MusicSessionManager:
+    def __init__(self):
+        self.sessions = {}
+        self._reaper = None
+
+    def get(self, guild_id, create=False):
+        session = self.sessions.get(guild_id)
+        if session is None and create:
+            session = self.sessions[guild_id] = MusicPlayer(guild_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, guild_id):
+        # Yields the guild's session with its lock held, making sure it wasn't closed while waiting for the lock
+        while True:
+            session = self.get(guild_id, create=True)
+            async with session.lock:
+                if self.sessions.get(guild_id) is session:
+                    yield session
+                    return
+
+    async def close(self, guild_id):
+        session = self.sessions.get(guild_id)
+        if session is None:
+            return
+        # Wait for any /play that is still extracting, so it doesn't carry on with a disconnected player
+        async with session.lock:
+            if self.sessions.get(guild_id) is session:
+                del self.sessions[guild_id]
+                await session.disconnect()
 
-music_player = MusicPlayer()
+    async def reap_idle(self):
+        now = time.monotonic()
+        for guild_id, session in list(self.sessions.items()):
+            voice_client = session.voice_client
+            # Paused sessions are waiting on a /resume, not idle
+            playing = voice_client is not None and (voice_client.is_playing() or voice_client.is_paused())
+            if session.lock.locked():
+                continue
+            if not playing and now - session.last_active > IDLE_TIMEOUT:
+                logger.info(f"Closing idle music session in guild {guild_id}")
+                try:
+                    await self.close(guild_id)
+                except Exception as e:
+                    logger.error(f"Error closing music session in guild {guild_id}: {str(e)}")
+            elif playing:
+                session.touch()
+
+    async def _run_reaper(self):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            await self.reap_idle()
+
+    def start(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._run_reaper())
+
+    async def stop(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for guild_id in list(self.sessions):
+            await self.close(guild_id)
+
+sessions = MusicSessionManager()
+metrics.gauge("bonk_music_sessions", "Guilds with an open music session", (), lambda: {(): len(sessions.sessions)})
+metrics.gauge("bonk_music_playing", "Music sessions currently playing audio", (), lambda: {
+    (): sum(1 for session in sessions.sessions.values() if session.voice_client is not None and session.voice_client.is_playing())
+})
 
 async def play(interaction: discord.Interaction, query: str):
     if not interaction.user.voice:
         await interaction.followup.send("You need to be in a voice channel to use this command.")
         return
 
-    channel = interaction.user.voice.channel
-    if not music_player.voice_client:
-        music_player.voice_client = await channel.connect()
-    elif music_player.voice_client.channel != channel:
-        await music_player.voice_client.move_to(channel)
-
-    try:
-        # Check if the query is a URL
-        if not query.startswith('http://') and not query.startswith('https://'):
-            # If not a URL, search for the video
-            search = VideosSearch(query, limit=1)
-            search_result = search.result()
-            if not search_result['result']:
-                await interaction.followup.send("No results found for the given query.")
+    async with sessions.acquire(interaction.guild_id) as music_player:
+        if len(music_player.queue) >= MAX_QUEUE_LENGTH:
+            await interaction.followup.send(f"The queue is full ({MAX_QUEUE_LENGTH} songs).")
+            return
+
+        music_player.text_channel = interaction.channel
+        music_player.loop = asyncio.get_running_loop()
+        await music_player.connect(interaction.user.voice.channel)
+
+        try:
+            # Check if the query is a URL
+            if not query.startswith('http://') and not query.startswith('https://'):
+                # If not a URL, search for the video
+                url = await search(query)
+                if url is None:
+                    await interaction.followup.send("No results found for the given query.")
+                    return
+                info = await get_info(url)
+                playlist_title, tracks = None, [Track(url, info['title'])]
+            else:
+                playlist_title, tracks = await get_tracks(query)
+
+            if not tracks:
+                await interaction.followup.send("No playable videos found.")
                 return
-            url = search_result['result'][0]['link']
-        else:
-            url = query
-
-        with yt_dlp.YoutubeDL(music_player.ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if 'entries' in info:
-                # This is a playlist or a list of videos
-                info = info['entries'][0]
-            title = info['title']
-
-        music_player.queue.append({'url': url, 'title': title})
-        await interaction.followup.send(f"Added to queue: {title}")
-
-        if not music_player.is_playing:
-            await music_player.play_next(interaction)
-    except Exception as e:
-        logger.error(f"Error in play command: {str(e)}")
-        await interaction.followup.send(f"An error occurred while trying to play the video: {str(e)}")
+
+            space = MAX_QUEUE_LENGTH - len(music_player.queue)
+            music_player.queue.extend(tracks[:space])
+            if playlist_title is not None:
+                message = f"Added {min(len(tracks), space)} songs from playlist: {playlist_title}"
+                if len(tracks) > space:
+                    message += f" (queue limit of {MAX_QUEUE_LENGTH} reached)"
+                await interaction.followup.send(message)
+            else:
+                await interaction.followup.send(f"Added to queue: {tracks[0].title}")
+
+            if not music_player.is_playing:
+                await music_player.play_next()
+            else:
+                music_player.prefetch()
+        except Exception as e:
+            logger.error(f"Error in play command: {str(e)}")
+            await interaction.followup.send(f"An error occurred while trying to play the video: {str(e)}")
 
 async def stop(interaction: discord.Interaction):
-    if music_player.voice_client:
-        music_player.is_playing = False
-        music_player.voice_client.stop()
-        await music_player.voice_client.disconnect()
-        music_player.queue.clear()
-        music_player.current_song = None
-        music_player.voice_client = None
+    music_player = sessions.get(interaction.guild_id)
+    # A locked session is a /play still connecting or extracting; close waits for it and then disconnects
+    if music_player and (music_player.voice_client or music_player.lock.locked()):
+        await sessions.close(interaction.guild_id)
         await interaction.followup.send("Stopped playback and cleared the queue.")
     else:
         await interaction.followup.send("I'm not currently in a voice channel.")
 
 async def pause(interaction: discord.Interaction):
-    if music_player.voice_client and music_player.voice_client.is_playing():
+    music_player = sessions.get(interaction.guild_id)
+    if music_player and music_player.voice_client and music_player.voice_client.is_playing():
         music_player.voice_client.pause()
         await interaction.followup.send("Playback paused.")
     else:
         await interaction.followup.send("Nothing is playing right now.")
 
 async def resume(interaction: discord.Interaction):
-    if music_player.voice_client and music_player.voice_client.is_paused():
+    music_player = sessions.get(interaction.guild_id)
+    if music_player and music_player.voice_client and music_player.voice_client.is_paused():
         music_player.voice_client.resume()
         await interaction.followup.send("Playback resumed.")
     else:
         await interaction.followup.send("Playback is not paused.")
 
 async def next(interaction: discord.Interaction):
-    if music_player.voice_client and music_player.is_playing:
+    music_player = sessions.get(interaction.guild_id)
+    if music_player and music_player.voice_client and music_player.is_playing:
         music_player.voice_client.stop()
         await interaction.followup.send("Skipping to the next song.")
     else:
-        await interaction.followup.send("No song is currently playing.")
\ No newline at end of file
+        await interaction.followup.send("No song is currently playing.")
@@ -1,7 +1,9 @@
 from src import log
+from src.conversations import conversation_store
 
 logger = log.setup_logger(__name__)
 
 async def handle_reset(interaction):
+    conversation_store.reset(interaction.channel_id)
     await interaction.followup.send("> **Info: I have forgotten everything.**")
     logger.warning("\x1b[31mClaude bot has been successfully reset\x1b[0m")
\ No newline at end of file
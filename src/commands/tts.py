@@ -1,64 +1,223 @@
 import discord
 from discord import app_commands
 import os
+import re
+import time
+import hashlib
+import threading
 from pathlib import Path
-from openai import OpenAI
-from src import log
+from openai import AsyncOpenAI
+from src import log, metrics
+from src.cache import CACHE_DIR
+from src.rate_limiter import rate_limiter
 import asyncio
 
 logger = log.setup_logger(__name__)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries on 429 are left to the rate limiter
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 VOICES = ["alloy", "echo", "fable", "onyx", "nova", "shimmer"]
+TTS_MODEL = "tts-1"
+# Ogg Opus can be handed to Discord voice without re-encoding
+TTS_FORMAT = "opus"
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", 300))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 3))
+
+TTS_CACHE_DIR = os.path.join(CACHE_DIR, "tts")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+class SpeechCache:
+    # Synthesized audio keyed on (text, voice, model); files are evicted oldest-access first
+    def __init__(self, root=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Running size of the cache, so the directory is only scanned at startup and when it is over the limit
+        self.bytes = None
+        self._evicting = False
+
+    def path_for(self, text, voice, model, ext="mp3"):
+        key = hashlib.sha256(f"{model}\n{voice}\n{text}".encode("utf-8")).hexdigest()
+        return Path(self.root, key[:2], f"{key}.{ext}")
+
+    def get(self, path):
+        try:
+            # Bump the modification time so eviction treats it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def _write(self, path, data):
+        # Returns how many bytes the cache grew by
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        temp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        return len(data) - replaced
+
+    async def put(self, path, data):
+        added = await asyncio.to_thread(self._write, path, data)
+        if self.bytes is not None:
+            self.bytes += added
+        if (self.bytes is None or self.bytes > self.max_bytes) and not self._evicting:
+            self._evicting = True
+            try:
+                self.bytes = await asyncio.to_thread(self._evict)
+            finally:
+                self._evicting = False
+        return path
+
+    def _evict(self):
+        # Returns the size of the cache after evicting
+        files = []
+        total = 0
+        for path in Path(self.root).glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return total
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except FileNotFoundError:
+                pass
+        return total
+
+speech_cache = SpeechCache()
+metrics.track_cache("tts", lambda: (speech_cache.hits, speech_cache.misses))
+
+def split_text(text, max_chars=TTS_CHUNK_CHARS):
+    sentences = []
+    for sentence in re.split(r'(?<=[.!?])\s+', text.strip()):
+        # Break up run-on sentences at word boundaries
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            sentences.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            sentences.append(sentence)
+    if not sentences:
+        return []
+
+    # The first sentence goes alone so playback can start as early as possible
+    chunks = [sentences[0]]
+    current = ""
+    for sentence in sentences[1:]:
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
 
 async def generate_speech(text: str, voice: str) -> Path:
-    speech_file_path = Path("temp_audio.mp3")
-    response = client.audio.speech.create(
-        model="tts-1",
+    speech_file_path = speech_cache.path_for(text, voice, TTS_MODEL, ext=TTS_FORMAT)
+    if speech_cache.get(speech_file_path) is not None:
+        logger.info(f"Using cached speech for {voice}: {text[:50]}")
+        return speech_file_path
+
+    started = time.monotonic()
+    response = await rate_limiter.call("openai/speech", lambda: client.audio.speech.create(
+        model=TTS_MODEL,
         voice=voice,
-        input=text
-    )
-    response.stream_to_file(speech_file_path)
+        input=text,
+        response_format=TTS_FORMAT
+    ))
+    await speech_cache.put(speech_file_path, response.content)
+    logger.info(f"Synthesized speech in {time.monotonic() - started:.2f}s")
     return speech_file_path
 
 async def play_audio(voice_client, audio_path):
-    audio_source = discord.FFmpegPCMAudio(audio_path)
-    if not voice_client.is_playing():
-        voice_client.play(audio_source, after=lambda e: print('Player error: %s' % e) if e else None)
-        while voice_client.is_playing():
-            await asyncio.sleep(1)
-    else:
-        print("Audio is already playing.")
+    if voice_client.is_playing():
+        logger.warning("Audio is already playing.")
+        return
+
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    def after(error):
+        # Called from the voice thread once playback ends
+        loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(error))
+
+    audio_source = discord.FFmpegOpusAudio(str(audio_path), codec='copy')
+    voice_client.play(audio_source, after=after)
+    error = await finished
+    if error:
+        logger.error(f"Player error: {error}")
+
+def synthesize_chunks(chunks, voice):
+    # Start every chunk now; the semaphore bounds how many requests run at once
+    semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+    async def synthesize(chunk):
+        async with semaphore:
+            return await generate_speech(chunk, voice)
+
+    return [asyncio.ensure_future(synthesize(chunk)) for chunk in chunks]
 
 async def handle_tts(interaction: discord.Interaction, text: str, voice: str):
     if not interaction.user.voice:
         await interaction.followup.send("You need to be in a voice channel to use this command.")
         return
 
+    chunks = split_text(text)
+    if not chunks:
+        await interaction.followup.send("There is no text to speak.")
+        return
+
+    tasks = []
     try:
-        # Generate speech
-        audio_file = await generate_speech(text, voice)
+        # Generate speech, sentence by sentence
+        tasks = synthesize_chunks(chunks, voice)
 
-        # Join voice channel
+        # Join voice channel while the first chunk is being generated
         voice_channel = interaction.user.voice.channel
         voice_client = await voice_channel.connect()
 
-        # Play audio
-        await play_audio(voice_client, audio_file)
+        metrics.tts_sessions.inc()
+        try:
+            # Play each chunk as soon as it is ready
+            for task in tasks:
+                audio_file = await task
+                await play_audio(voice_client, audio_file)
+        finally:
+            metrics.tts_sessions.dec()
 
         # Disconnect after playing
         await voice_client.disconnect()
 
-        # Delete the temporary audio file
-        os.remove(audio_file)
-
         await interaction.followup.send(f"TTS audio played successfully using the {voice} voice.")
     except Exception as e:
         logger.error(f"Error in TTS command: {str(e)}")
         await interaction.followup.send(f"An error occurred: {str(e)}")
         if interaction.guild.voice_client:
             await interaction.guild.voice_client.disconnect()
+    finally:
+        for task in tasks:
+            task.cancel()
 
 class VoiceSelect(discord.ui.Select):
     def __init__(self, text: str):
@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict, deque
+from src import log
+
+logger = log.setup_logger(__name__)
+
+# Upper bound on conversations kept in memory; the least recently used is dropped first
+MAX_CONVERSATIONS = int(os.getenv("MAX_CONVERSATIONS", 5000))
+# Approximate prompt tokens of history sent with each message
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 6000))
+MAX_TURNS = int(os.getenv("MAX_CONVERSATION_TURNS", 40))
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text
+    return len(text) // 4 + 1
+
+class Conversation:
+    __slots__ = ("turns", "tokens")
+
+    def __init__(self):
+        # Each turn is a (role, text, tokens) tuple
+        self.turns = deque()
+        self.tokens = 0
+
+    def append(self, role, text):
+        tokens = estimate_tokens(text)
+        self.turns.append((role, text, tokens))
+        self.tokens += tokens
+
+    def trim(self, budget, max_turns):
+        # Drop whole user/assistant exchanges so the history always starts with a user turn
+        while self.turns and (self.tokens > budget or len(self.turns) > max_turns):
+            for _ in range(2):
+                if self.turns:
+                    _, _, tokens = self.turns.popleft()
+                    self.tokens -= tokens
+
+class ConversationStore:
+    def __init__(self, max_conversations=MAX_CONVERSATIONS, token_budget=CONTEXT_TOKEN_BUDGET, max_turns=MAX_TURNS):
+        self.max_conversations = max_conversations
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.conversations = OrderedDict()
+
+    def __len__(self):
+        return len(self.conversations)
+
+    def build_messages(self, key, message):
+        messages = []
+        conversation = self.conversations.get(key)
+        if conversation is not None:
+            self.conversations.move_to_end(key)
+            # Leave room for the new message inside the budget
+            budget = self.token_budget - estimate_tokens(message)
+            used = 0
+            kept = []
+            for role, text, tokens in reversed(conversation.turns):
+                if used + tokens > budget:
+                    break
+                kept.append((role, text))
+                used += tokens
+            kept.reverse()
+            # The API expects the conversation to open with a user turn
+            if kept and kept[0][0] != "user":
+                kept.pop(0)
+            messages = [{"role": role, "content": text} for role, text in kept]
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def add_exchange(self, key, message, reply):
+        if not reply or not reply.strip():
+            # Anthropic rejects empty assistant turns, which would break every later message in the conversation
+            logger.warning(f"Not recording an empty reply in conversation {key}")
+            return
+        conversation = self.conversations.get(key)
+        if conversation is None:
+            conversation = self.conversations[key] = Conversation()
+        else:
+            self.conversations.move_to_end(key)
+        conversation.append("user", message)
+        conversation.append("assistant", reply)
+        conversation.trim(self.token_budget, self.max_turns)
+
+        while len(self.conversations) > self.max_conversations:
+            evicted, _ = self.conversations.popitem(last=False)
+            logger.debug(f"Evicted conversation {evicted}")
+
+    def reset(self, key):
+        return self.conversations.pop(key, None) is not None
+
+conversation_store = ConversationStore()
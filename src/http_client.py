@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import asyncio
+import aiohttp
+from src import log
+
+logger = log.setup_logger(__name__)
+
+# Connection pool settings shared by every provider call
+MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", 10))
+KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+REQUEST_TIMEOUT = float(os.getenv("HTTP_REQUEST_TIMEOUT", 300))
+
+class HTTPResponse:
+    def __init__(self, status_code, headers, content, digest=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        # sha256 of the body, only set by get_hashed
+        self.digest = digest
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+class HTTPClient:
+    def __init__(self):
+        self.session = None
+        self._lock = asyncio.Lock()
+
+    async def startup(self):
+        async with self._lock:
+            if self.session is None or self.session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=MAX_CONNECTIONS,
+                    limit_per_host=MAX_CONNECTIONS_PER_HOST,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=300,
+                )
+                timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+                self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+                logger.info("HTTP connection pool started")
+        return self.session
+
+    async def shutdown(self):
+        async with self._lock:
+            if self.session is not None and not self.session.closed:
+                await self.session.close()
+                logger.info("HTTP connection pool closed")
+            self.session = None
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            return await self.startup()
+        return self.session
+
+    async def request(self, method, url, **kwargs):
+        session = await self.get_session()
+        async with session.request(method, url, **kwargs) as resp:
+            content = await resp.read()
+            return HTTPResponse(resp.status, resp.headers, content)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def get_hashed(self, url, chunk_size=64 * 1024, **kwargs):
+        # Hashes the body while it streams in, so callers don't need a second pass over it
+        session = await self.get_session()
+        digest = hashlib.sha256()
+        body = bytearray()
+        async with session.get(url, **kwargs) as resp:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                digest.update(chunk)
+                body.extend(chunk)
+            return HTTPResponse(resp.status, resp.headers, bytes(body), digest.hexdigest())
+
+http_client = HTTPClient()
+
+def form_data(data=None, files=None):
+    # Builds a multipart body the same way requests does for data=/files=
+    form = aiohttp.FormData()
+    for name, value in (data or {}).items():
+        form.add_field(name, str(value))
+    for name, file in (files or {}).items():
+        if isinstance(file, tuple):
+            filename, content, content_type = file
+        else:
+            filename, content, content_type = name, file, None
+        form.add_field(name, content, filename=filename, content_type=content_type)
+    return form
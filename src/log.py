@@ -1,7 +1,23 @@
 import os
+import copy
+import json
+import queue
+import atexit
+import random
 import logging
+import threading
+import contextvars
 import logging.handlers
 
+# Set per command (e.g. the interaction or chat message id) and attached to every record logged while handling it
+request_id = contextvars.ContextVar("request_id", default=None)
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "text" for the coloured console format, "json" for one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Keep only a share of a noisy module's records below WARNING, e.g. "src.art.video_poller=0.1,src.commands.music=0.5"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
 class CustomFormatter(logging.Formatter):
     LEVEL_COLORS = [
         (logging.DEBUG, '\x1b[40;1m'),
@@ -33,31 +49,128 @@ class CustomFormatter(logging.Formatter):
         record.exc_text = None
         return output
 
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the message arguments here; tracebacks are formatted by the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class RequestIdFilter(logging.Filter):
+    # Runs on the thread that logged, where the context variable is still set
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.resolved = {}
+
+    def rate_for(self, name):
+        rate = self.resolved.get(name)
+        if rate is None:
+            # The most specific configured prefix wins
+            matches = [prefix for prefix in self.rates if name == prefix or name.startswith(prefix + ".")]
+            rate = self.rates[max(matches, key=len)] if matches else 1.0
+            self.resolved[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in value.split(","):
+        name, _, rate = item.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = float(rate)
+    return rates
+
+_listener = None
+_stopped = False
+_lock = threading.Lock()
+
+def configure():
+    # Records are queued on the calling thread and formatted and written by a listener thread,
+    # so logging from the event loop never waits on the console or disk
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+
+        formatter = JsonFormatter() if LOG_FORMAT == "json" else CustomFormatter()
+        # create console handler
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(formatter)
+        handlers = [console_handler]
+
+        if os.getenv("LOGGING")=="True": #Check if logging is enabled
+            # specify that the log file path is the same as `main.py` file path
+            grandparent_dir = os.path.abspath(f"{__file__}/../../")
+            log_name='chatgpt_discord_bot.log'
+            log_path = os.path.join(grandparent_dir, log_name)
+            # create local log handler
+            log_handler = logging.handlers.RotatingFileHandler(
+                filename=log_path,
+                encoding='utf-8',
+                maxBytes=32 * 1024 * 1024,  # 32 MiB
+                backupCount=2,  # Rotate through 5 files
+            )
+            log_handler.setFormatter(formatter)
+            handlers.append(log_handler)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(RequestIdFilter())
+        rates = parse_sample_rates(LOG_SAMPLE_RATES)
+        if rates:
+            queue_handler.addFilter(SamplingFilter(rates))
+
+        # Libraries only get through at WARNING and above; the bot's own modules at LOG_LEVEL
+        root = logging.getLogger()
+        root.setLevel(logging.WARNING)
+        root.addHandler(queue_handler)
+        logging.getLogger("src").setLevel(LOG_LEVEL)
+        logging.getLogger("discord").setLevel(logging.INFO)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+def shutdown():
+    # Flushes whatever is still queued
+    global _stopped
+    with _lock:
+        if _listener is not None and not _stopped:
+            _listener.stop()
+            _stopped = True
+
 def setup_logger(module_name:str) -> logging.Logger:
-    # create logger
+    # Safe to call from every module, handlers are only ever installed once
+    configure()
     library, _, _ = module_name.partition('.py')
     logger = logging.getLogger(library)
-    logger.setLevel(logging.INFO)
-    # create console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(CustomFormatter())
-    # Add console handler to logger
-    logger.addHandler(console_handler)
-
-    if os.getenv("LOGGING")=="True": #Check if logging is enabled
-        # specify that the log file path is the same as `main.py` file path
-        grandparent_dir = os.path.abspath(f"{__file__}/../../")
-        log_name='chatgpt_discord_bot.log'
-        log_path = os.path.join(grandparent_dir, log_name)
-        # create local log handler
-        log_handler = logging.handlers.RotatingFileHandler(
-            filename=log_path,
-            encoding='utf-8',
-            maxBytes=32 * 1024 * 1024,  # 32 MiB
-            backupCount=2,  # Rotate through 5 files
-        )
-        log_handler.setFormatter(CustomFormatter())
-        logger.addHandler(log_handler)
-
-    return logger
\ No newline at end of file
+    if not library.startswith("src"):
+        # Scripts run directly (e.g. __main__) aren't under the "src" logger
+        logger.setLevel(LOG_LEVEL)
+    return logger
@@ -0,0 +1,201 @@
+import os
+import time
+import bisect
+from collections import defaultdict
+from aiohttp import web
+from src import log
+
+logger = log.setup_logger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True") == "True"
+# Only listen locally by default; put a scraper on the same host or a proxy in front to read it remotely
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9464))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # Optional function returning {label values: value}, read at scrape time instead of recording events
+        self.collect = collect
+        self.values = defaultdict(float)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        values = self.collect() if self.collect else self.values
+        for labels, value in list(values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.values[self.key(labels)] += amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        self.values[self.key(labels)] += amount
+
+    def dec(self, amount=1, **labels):
+        self.values[self.key(labels)] -= amount
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in list(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labelnames, labels, [("le", format_value(bound))]), cumulative
+            yield f"{self.name}_sum", format_labels(self.labelnames, labels), series[-1]
+            yield f"{self.name}_count", format_labels(self.labelnames, labels), cumulative
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Error collecting metric {metric.name}: {str(e)}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def counter(name, help, labelnames=(), collect=None):
+    return registry.register(Counter(name, help, labelnames, collect))
+
+def gauge(name, help, labelnames=(), collect=None):
+    return registry.register(Gauge(name, help, labelnames, collect))
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+# Commands and the queue
+command_wait = histogram("bonk_queue_wait_seconds", "Time commands spent queued before a worker picked them up", ("lane", "command"))
+command_duration = histogram("bonk_command_duration_seconds", "Time spent running commands", ("lane", "command"))
+commands = counter("bonk_commands_total", "Commands run, by outcome", ("lane", "command", "status"))
+commands_in_progress = gauge("bonk_commands_in_progress", "Commands currently running", ("lane",))
+
+# Provider calls
+provider_duration = histogram("bonk_provider_request_duration_seconds", "Latency of provider API calls", ("provider",))
+provider_requests = counter("bonk_provider_requests_total", "Provider API calls, by status", ("provider", "status"))
+provider_bytes = counter("bonk_provider_response_bytes_total", "Bytes received from provider API calls", ("provider",))
+provider_throttled = counter("bonk_provider_throttled_total", "Provider calls that were rate limited and retried", ("provider",))
+
+# Voice
+tts_sessions = gauge("bonk_tts_sessions", "TTS playbacks currently connected to voice")
+
+caches = {}
+
+def collect_caches(index):
+    def collect():
+        values = {}
+        for name, read in caches.items():
+            hits, misses = read()
+            values[(name,)] = (hits, misses, hits / (hits + misses) if hits + misses else 0.0)[index]
+        return values
+    return collect
+
+counter("bonk_cache_hits_total", "Cache lookups that were served from the cache", ("cache",), collect_caches(0))
+counter("bonk_cache_misses_total", "Cache lookups that missed", ("cache",), collect_caches(1))
+gauge("bonk_cache_hit_ratio", "Share of cache lookups that hit", ("cache",), collect_caches(2))
+
+def track_cache(name, read):
+    # read returns (hits, misses) and is only called when metrics are scraped
+    caches[name] = read
+
+def observe_provider_call(provider, started, result=None, error=None):
+    provider_duration.observe(time.monotonic() - started, provider=provider)
+    if error is not None:
+        status = getattr(error, "status_code", None) or getattr(error, "status", None) or type(error).__name__
+    else:
+        status = getattr(result, "status_code", None) or "ok"
+        content = getattr(result, "content", None)
+        if isinstance(content, (bytes, bytearray)):
+            provider_bytes.inc(len(content), provider=provider)
+    provider_requests.inc(provider=provider, status=status)
+
+class MetricsServer:
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self):
+        if not METRICS_ENABLED or self.runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as e:
+            logger.error(f"Couldn't start metrics endpoint on {self.host}:{self.port}: {str(e)}")
+            await self.runner.cleanup()
+            self.runner = None
+            return
+        logger.info(f"Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics_server = MetricsServer()
@@ -1,57 +1,137 @@
 import asyncio
-from collections import deque
+import os
+import time
 import discord
 from functools import wraps
+from src import log, metrics
+
+# Maximum number of commands each lane runs at the same time
+LANE_LIMITS = {
+    "light": int(os.getenv("QUEUE_LIGHT_WORKERS", 4)),
+    "image": int(os.getenv("QUEUE_IMAGE_WORKERS", 4)),
+    "video": int(os.getenv("QUEUE_VIDEO_WORKERS", 2)),
+    "voice": int(os.getenv("QUEUE_VOICE_WORKERS", 4)),
+}
+
+# Commands not listed here run in the "light" lane. /draw itself only prepares the buttons; the image generation
+# they start is sent to the "image" lane with run_in_lane
+COMMAND_LANES = {
+    "imagine_command": "video",
+    "model_3d_command": "video",
+    "play_command": "voice",
+    "stop_command": "voice",
+    "pause_command": "voice",
+    "resume_command": "voice",
+    "next_command": "voice",
+    "tts_command": "voice",
+}
+
+DEFAULT_LANE = "light"
 
 class QueueManager:
-    def __init__(self):
-        self.queue = asyncio.Queue()
-        self.is_processing = False
+    def __init__(self, lane_limits=None):
+        self.lane_limits = dict(lane_limits or LANE_LIMITS)
+        self.queues = {lane: asyncio.Queue() for lane in self.lane_limits}
+        self.workers = {lane: [] for lane in self.lane_limits}
+        self.detached = set()
+        metrics.gauge("bonk_queue_depth", "Commands waiting for a worker", ("lane",),
+                      lambda: {(lane,): queue.qsize() for lane, queue in self.queues.items()})
+
+    def lane_for(self, func):
+        lane = COMMAND_LANES.get(func.__name__, DEFAULT_LANE)
+        return lane if lane in self.queues else DEFAULT_LANE
 
-    async def add_to_queue(self, interaction: discord.Interaction, task):
+    async def add_to_queue(self, interaction: discord.Interaction, task, lane=DEFAULT_LANE, command="unknown"):
         # Immediately acknowledge the interaction
         if not interaction.response.is_done():
             await interaction.response.defer(thinking=True)
-        
-        await self.queue.put((interaction, task))
-        
-        if not self.is_processing:
-            asyncio.create_task(self.process_queue())
 
-    async def process_queue(self):
-        self.is_processing = True
-        while not self.queue.empty():
-            interaction, task = await self.queue.get()
+        await self.queues[lane].put((interaction, task, command, time.monotonic()))
+        self.ensure_workers(lane)
+
+    def ensure_workers(self, lane):
+        # Workers are started lazily so the queue can be created before the event loop runs
+        workers = [worker for worker in self.workers[lane] if not worker.done()]
+        while len(workers) < max(1, self.lane_limits[lane]):
+            workers.append(asyncio.create_task(self.process_queue(lane)))
+        self.workers[lane] = workers
+
+    async def process_queue(self, lane):
+        queue = self.queues[lane]
+        while True:
+            interaction, task, command, enqueued_at = await queue.get()
+            started = time.monotonic()
+            metrics.command_wait.observe(started - enqueued_at, lane=lane, command=command)
+            metrics.commands_in_progress.inc(lane=lane)
+            status = "ok"
+            # Everything logged while this command runs carries its interaction id
+            token = log.request_id.set(str(interaction.id))
 
             try:
                 # Execute the task
                 await task()
             except discord.errors.NotFound:
                 # Interaction may have expired, log and continue
+                status = "expired"
                 print(f"Interaction {interaction.id} not found. It may have expired.")
             except Exception as e:
+                status = "error"
                 # Log the error and attempt to notify the user
-                print(f"Error processing task: {str(e)}")
+                print(f"Error processing task in {lane} lane: {str(e)}")
                 try:
                     await interaction.followup.send(f"An error occurred: {str(e)}")
                 except discord.errors.NotFound:
                     print(f"Couldn't send error message to user for interaction {interaction.id}")
             finally:
+                log.request_id.reset(token)
+                metrics.commands_in_progress.dec(lane=lane)
+                metrics.command_duration.observe(time.monotonic() - started, lane=lane, command=command)
+                metrics.commands.inc(lane=lane, command=command, status=status)
                 # Mark the task as done
-                self.queue.task_done()
+                queue.task_done()
+
+    async def run_in_lane(self, lane, interaction, func, *args, command="unknown"):
+        # Runs func(*args) on one of the lane's workers and returns its result, for work started outside a command
+        # such as a button press. Errors are raised here for the caller to report rather than handled by the worker
+        future = asyncio.get_running_loop().create_future()
 
-        self.is_processing = False
+        async def task():
+            if future.cancelled():
+                # The caller gave up while this was queued
+                return
+            try:
+                result = await func(*args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+        await self.queues[lane].put((interaction, task, command, time.monotonic()))
+        self.ensure_workers(lane)
+        return await future
+
+    def run_detached(self, coro):
+        # Lets a command finish its work outside the lane, e.g. while waiting on a remote render
+        task = asyncio.create_task(coro)
+        self.detached.add(task)
+        task.add_done_callback(self.detached.discard)
+        return task
 
 queue_manager = QueueManager()
 
 def enqueue(func):
+    lane = queue_manager.lane_for(func)
+    command = func.__name__.replace("_command", "")
+
     @wraps(func)
     async def wrapper(*args, **kwargs):
         interaction = args[0] if isinstance(args[0], discord.Interaction) else kwargs.get('interaction')
         if not interaction:
             raise ValueError("Could not find discord.Interaction in arguments")
-        
+
         task = lambda: func(*args, **kwargs)
-        await queue_manager.add_to_queue(interaction, task)
-    
-    return wrapper
\ No newline at end of file
+        await queue_manager.add_to_queue(interaction, task, lane, command)
+
+    return wrapper
@@ -0,0 +1,196 @@
+import os
+import time
+import random
+import asyncio
+import contextlib
+from email.utils import parsedate_to_datetime
+from src import log, metrics
+from src.http_client import HTTPResponse
+
+logger = log.setup_logger(__name__)
+
+# (requests per minute, burst, concurrent requests) per provider, optionally narrowed per endpoint as "provider/endpoint".
+# Override any of them with RATE_LIMIT_<PROVIDER>[_<ENDPOINT>]="rpm,burst,concurrency"
+DEFAULT_LIMITS = {
+    "anthropic": (50, 10, 8),
+    "openai": (500, 20, 16),
+    "openai/images": (15, 5, 4),
+    "openai/speech": (50, 10, 8),
+    "replicate": (600, 20, 8),
+    "stability": (900, 30, 16),
+}
+MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", 6))
+BACKOFF_BASE = float(os.getenv("RATE_LIMIT_BACKOFF_BASE", 1))
+BACKOFF_MAX = float(os.getenv("RATE_LIMIT_BACKOFF_MAX", 60))
+# 529 is Anthropic's "overloaded", which it asks clients to treat like a 429
+RETRY_STATUSES = {429, 529}
+
+class RateLimitError(Exception):
+    pass
+
+def load_limit(key):
+    value = os.getenv("RATE_LIMIT_" + key.upper().replace("/", "_"))
+    if value:
+        rpm, burst, concurrency = (float(part) for part in value.split(","))
+        return rpm, int(burst), int(concurrency)
+    return DEFAULT_LIMITS.get(key)
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def rate_limit_status(result):
+    # Returns (status, headers) when a response or exception says to slow down, otherwise None
+    if isinstance(result, HTTPResponse):
+        status, headers = result.status_code, result.headers
+    else:
+        # Anthropic and OpenAI errors carry status_code and the response, Replicate's carry status
+        status = getattr(result, "status_code", None) or getattr(result, "status", None)
+        response = getattr(result, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        if status is None and type(result).__name__ == "RateLimitError":
+            status = 429
+    if status in RETRY_STATUSES:
+        return status, headers
+    return None
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # asyncio.Lock wakes waiters in order, so callers are served first come first served
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Limit:
+    def __init__(self, key, rpm, burst, concurrency):
+        self.key = key
+        self.bucket = TokenBucket(rpm / 60, burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.blocked_until = 0.0
+        self.waiting = 0
+        self.throttled = 0
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+            try:
+                # Sit out any Retry-After the provider handed back, then take a token
+                while (delay := self.blocked_until - time.monotonic()) > 0:
+                    await asyncio.sleep(delay)
+                await self.bucket.acquire()
+            except BaseException:
+                self.semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+    def block(self, delay):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+class RateLimiter:
+    def __init__(self):
+        self.limits = {}
+
+    def limit(self, key):
+        if key not in self.limits:
+            config = load_limit(key)
+            self.limits[key] = Limit(key, *config) if config else None
+        return self.limits[key]
+
+    def limits_for(self, key):
+        # The endpoint limit (if any) and then the provider-wide one
+        provider = key.split("/")[0]
+        keys = [key, provider] if key != provider else [provider]
+        return [limit for limit in (self.limit(k) for k in keys) if limit is not None]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, key):
+        acquired = []
+        try:
+            for limit in self.limits_for(key):
+                await limit.acquire()
+                acquired.append(limit)
+            yield
+        finally:
+            for limit in reversed(acquired):
+                limit.release()
+
+    def backoff(self, key, status, headers, attempt):
+        # Works out the wait before the next attempt and holds every caller of the provider back for it
+        delay = parse_retry_after(headers.get("Retry-After") or headers.get("retry-after"))
+        if delay is None:
+            # Full jitter keeps callers that were throttled together from retrying together
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        else:
+            delay += random.uniform(0, BACKOFF_BASE)
+        limits = self.limits_for(key)
+        for limit in limits:
+            limit.throttled += 1
+        metrics.provider_throttled.inc(provider=key)
+        if limits:
+            limits[-1].block(delay)
+        logger.warning(f"{key} returned {status}, retrying in {delay:.1f}s (attempt {attempt + 1})")
+        return delay
+
+    async def call(self, key, make_call, retries=MAX_RETRIES):
+        # make_call is a zero-argument function returning a fresh awaitable, since request bodies can't be resent
+        for attempt in range(retries + 1):
+            async with self.slot(key):
+                started = time.monotonic()
+                try:
+                    result = await make_call()
+                except Exception as e:
+                    metrics.observe_provider_call(key, started, error=e)
+                    throttled = rate_limit_status(e)
+                    if throttled is None or attempt == retries:
+                        raise
+                else:
+                    metrics.observe_provider_call(key, started, result)
+                    throttled = rate_limit_status(result)
+                    if throttled is None:
+                        return result
+                    if attempt == retries:
+                        raise RateLimitError(f"{key} is still rate limited after {retries} retries")
+            delay = self.backoff(key, *throttled, attempt)
+            if not self.limits_for(key):
+                # Unconfigured keys have nothing to block, so wait here instead
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            key: {
+                "waiting": limit.waiting,
+                "throttled": limit.throttled,
+            }
+            for key, limit in self.limits.items() if limit is not None
+        }
+
+rate_limiter = RateLimiter()
+metrics.gauge("bonk_rate_limit_waiting", "Calls waiting on a provider rate limit", ("limit",),
+              lambda: {(key,): limit.waiting for key, limit in rate_limiter.limits.items() if limit is not None})
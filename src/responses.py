@@ -1,13 +1,17 @@
 # src/responses.py
 
 import os
+import time
+import asyncio
 import anthropic
 from dotenv import load_dotenv
-import logging
+import hashlib
+from src.conversations import conversation_store
+from src.cache import PersistentCache
+from src.rate_limiter import rate_limiter, rate_limit_status, MAX_RETRIES
+from src import log, metrics
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+logger = log.setup_logger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -20,39 +24,93 @@ if not anthropic_api_key:
 logger.debug(f"Anthropic API Key: {anthropic_api_key[:5]}{'*' * (len(anthropic_api_key) - 5) if anthropic_api_key else 'Not set'}")
 
 try:
-    anthropic_client = anthropic.Anthropic(api_key=anthropic_api_key)
+    # Retries on 429/529 are left to the rate limiter so they queue behind the provider limit
+    anthropic_client = anthropic.AsyncAnthropic(api_key=anthropic_api_key, max_retries=0)
     logger.debug("Anthropic client initialized successfully")
 except Exception as e:
     logger.error(f"Error initializing Anthropic client: {str(e)}")
     raise
 
-async def handle_response(message) -> str:
+async def handle_response(message, conversation_id=None) -> str:
     logger.info(f"Handling response for message: {message[:50]}...")  # Log first 50 chars of message
     try:
         logger.info("Sending request to Anthropic API")
-        response = anthropic_client.messages.create(
+        messages = conversation_store.build_messages(conversation_id, message)
+        response = await rate_limiter.call("anthropic/messages", lambda: anthropic_client.messages.create(
             model="claude-3-5-sonnet-20240620",
             max_tokens=1000,
             temperature=0.7,
             system="You are Claude, an AI assistant.",
-            messages=[
-                {
-                    "role": "user",
-                    "content": message
-                }
-            ]
-        )
+            messages=messages
+        ))
         logger.info("Received response from Anthropic API")
-        return response.content[0].text
+        reply = response.content[0].text
+        if conversation_id is not None:
+            conversation_store.add_exchange(conversation_id, message, reply)
+        return reply
     except Exception as e:
         logger.exception(f"Error in handle_response: {e}")
         return f"An error occurred: {str(e)}"
 
+async def stream_response(message, conversation_id=None):
+    logger.info(f"Streaming response for message: {message[:50]}...")  # Log first 50 chars of message
+    try:
+        logger.info("Opening stream to Anthropic API")
+        reply = []
+        messages = conversation_store.build_messages(conversation_id, message)
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async with rate_limiter.slot("anthropic/messages"):
+                    async with anthropic_client.messages.stream(
+                        model="claude-3-5-sonnet-20240620",
+                        max_tokens=1000,
+                        temperature=0.7,
+                        system="You are Claude, an AI assistant.",
+                        messages=messages
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            reply.append(text)
+                            yield text
+                metrics.observe_provider_call("anthropic/messages", started)
+                break
+            except Exception as e:
+                metrics.observe_provider_call("anthropic/messages", started, error=e)
+                # Only retry if nothing has been shown yet, otherwise the reply would restart mid-message
+                throttled = rate_limit_status(e)
+                if throttled is None or reply or attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(rate_limiter.backoff("anthropic/messages", *throttled, attempt))
+                attempt += 1
+        logger.info("Finished streaming response from Anthropic API")
+        if conversation_id is not None:
+            conversation_store.add_exchange(conversation_id, message, "".join(reply))
+    except Exception as e:
+        logger.exception(f"Error in stream_response: {e}")
+        raise
+
+ENHANCE_MODEL = "claude-3-5-sonnet-20240620"
+
+# Enhancement runs at temperature 0, so the same prompt always enhances the same way
+enhance_cache = PersistentCache("enhanced_prompts", max_entries=int(os.getenv("ENHANCE_CACHE_SIZE", 20000)))
+metrics.track_cache("enhanced_prompts", lambda: (enhance_cache.memory_hits + enhance_cache.disk_hits, enhance_cache.misses))
+
+def enhance_cache_key(prompt: str) -> str:
+    normalized = " ".join(prompt.split()).casefold()
+    return hashlib.sha256(f"{ENHANCE_MODEL}\n{normalized}".encode("utf-8")).hexdigest()
+
 async def enhance_prompt(prompt: str) -> str:
     try:
+        cache_key = enhance_cache_key(prompt)
+        cached = await enhance_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Enhanced prompt (cached): {cached}")
+            return cached
+
         logger.info(f"Enhancing prompt: {prompt}")
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20240620",
+        response = await rate_limiter.call("anthropic/messages", lambda: anthropic_client.messages.create(
+            model=ENHANCE_MODEL,
             max_tokens=100,
             temperature=0,
             messages=[
@@ -61,9 +119,10 @@ async def enhance_prompt(prompt: str) -> str:
                     "content": f"You are an AI assistant tasked with enhancing text-to-image prompts. Your goal is to take a simple initial prompt and expand it into a more detailed and vivid description that can be used to generate more interesting and specific images.\n\nWhen enhancing the prompt, consider the following guidelines:\n1. Add specific details about the setting or environment\n2. Include information about lighting, time of day, or weather\n3. Suggest a particular art style or medium\n4. Incorporate additional elements that complement the main subject\n5. Describe emotions, actions, or interactions if applicable\n6. The enhanced prompt must be shorter than 60 tokens or 200 characters in total\n7. Try to adhere to the original subject and enhance it as you see fit whilst following all the rules\n\nHere is the initial prompt to enhance:\n<initial_prompt>\n{prompt}\n</initial_prompt>\n\nYour output should simply just be the enhanced prompt"
                 }
             ]
-        )
+        ))
         enhanced_prompt = response.content[0].text.strip()
         logger.info(f"Enhanced prompt: {enhanced_prompt}")
+        await enhance_cache.set(cache_key, enhanced_prompt)
         return enhanced_prompt
     except Exception as e:
         logger.exception(f"Error enhancing prompt: {str(e)}")
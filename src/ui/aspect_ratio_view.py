@@ -1,8 +1,10 @@
 import io
 import discord
 from src import log
+from src.queue_manager import queue_manager
 from src.art import image_generation
-from src.ui.generate_video_view import GenerateVideoView
+from src.art.grid import compose_grid
+from src.ui.generate_video_view import GenerateVideoView, VariantVideoView
 
 logger = log.setup_logger(__name__)
 
@@ -65,19 +67,26 @@ class AspectRatioView(discord.ui.View):
     async def generate_image(self, interaction, aspect_ratio):
         try:
             model_name = "Stable Diffusion 3" if self.model == "sd" else "Replicate"
+            if self.parent_view.variants > 1:
+                await self.generate_variants(interaction, model_name, aspect_ratio)
+                return
+
+            # Waiting for an image worker and the provider can outlast the views' timeouts, which would otherwise
+            # overwrite the progress message
+            self.parent_view.interaction_completed = True
+            self.parent_view.stop()
+            self.stop()
             await interaction.edit_original_response(content=f"Generating image with {model_name} (Aspect Ratio: {aspect_ratio})... This may take a minute or two.", view=None)
             
-            if self.model == "sd":
-                result = await image_generation.generate_image_sd(self.parent_view.prompt, aspect_ratio)
-            else:
-                result = await image_generation.generate_image_replicate(self.parent_view.prompt, aspect_ratio)
+            provider, result = await queue_manager.run_in_lane("image", interaction, image_generation.generate_image,
+                                                               self.model, self.parent_view.prompt, aspect_ratio, command="draw")
+            if provider != self.model:
+                model_name = f"{image_generation.IMAGE_PROVIDERS[provider][0]} (instead of {model_name})"
 
             if isinstance(result, str):
                 # This is an error message
                 logger.error(f"Error in {model_name}: {result}")
                 await interaction.edit_original_response(content=f"> **Error in {model_name}: {result}**", view=None)
-                self.parent_view.interaction_completed = True
-                self.parent_view.stop()
             else:
                 # This is a tuple containing image_data and image_path
                 image_data, self.parent_view.image_path = result
@@ -86,16 +95,52 @@ class AspectRatioView(discord.ui.View):
                 embed.description = f"> **Model: {model_name}**\n> **Aspect Ratio: {aspect_ratio}**"
                 embed.set_image(url="attachment://image.png")
                 
-                view = GenerateVideoView(self.parent_view.image_path)
+                view = GenerateVideoView(image_data)
                 
                 await interaction.edit_original_response(content=None, attachments=[file], embed=embed, view=view)
-                self.parent_view.interaction_completed = True
-                self.parent_view.stop()
         except Exception as e:
             logger.exception(f"Error in generate_image: {str(e)}")
             await interaction.edit_original_response(content=f"> **Error: An error occurred while generating the image.**", view=None)
-            self.parent_view.interaction_completed = True
-            self.parent_view.stop()
+
+    async def generate_variants(self, interaction, model_name, aspect_ratio):
+        count = self.parent_view.variants
+        # Several rounds of variants can outlast the views' timeouts, which would otherwise overwrite the progress message
+        self.parent_view.interaction_completed = True
+        self.parent_view.stop()
+        self.stop()
+        try:
+            await interaction.edit_original_response(content=f"Generating {count} variants with {model_name} (Aspect Ratio: {aspect_ratio})... This may take a minute or two.", view=None)
+
+            results = await queue_manager.run_in_lane("image", interaction, image_generation.generate_variants,
+                                                      self.model, self.parent_view.prompt, aspect_ratio, count, command="draw")
+            # Keep the original numbering so the buttons match the grid labels even if some variants failed
+            variants = {}
+            errors = []
+            for number, result in enumerate(results, start=1):
+                if isinstance(result, str):
+                    logger.error(f"Error in {model_name} variant {number}: {result}")
+                    errors.append(f"> **Variant {number}: {result}**")
+                else:
+                    variants[number] = result[0]
+
+            if not variants:
+                await interaction.edit_original_response(content=f"> **Error in {model_name}: {results[0]}**", view=None)
+                return
+
+            grid_data = await compose_grid(list(variants.values()), [str(number) for number in variants])
+            file = discord.File(io.BytesIO(grid_data), filename="variants.png")
+            embed = discord.Embed(title=f"> **{self.parent_view.prompt}**")
+            embed.description = f"> **Model: {model_name}**\n> **Aspect Ratio: {aspect_ratio}**"
+            if errors:
+                embed.description += "\n" + "\n".join(errors)
+            embed.set_image(url="attachment://variants.png")
+
+            view = VariantVideoView(variants)
+
+            await interaction.edit_original_response(content=None, attachments=[file], embed=embed, view=view)
+        except Exception as e:
+            logger.exception(f"Error in generate_variants: {str(e)}")
+            await interaction.edit_original_response(content=f"> **Error: An error occurred while generating the variants.**", view=None)
 
     async def on_timeout(self):
         if not self.parent_view.interaction_completed:
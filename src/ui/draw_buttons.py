@@ -1,7 +1,9 @@
 import io
 import discord
 from src import log
+from src.queue_manager import queue_manager
 from src.art import image_generation
+from src.art.grid import compose_grid
 from src.ui.aspect_ratio_view import AspectRatioView
 from src.ui.generate_video_view import GenerateVideoView
 from src.art.error_handler import ContentModerationError
@@ -9,10 +11,12 @@ from src.art.error_handler import ContentModerationError
 logger = log.setup_logger(__name__)
 
 class DrawButtons(discord.ui.View):
-    def __init__(self, prompt, interaction):
+    def __init__(self, prompt, interaction, variants=1):
         super().__init__(timeout=60.0)
         self.prompt = prompt
         self.interaction = interaction
+        # Dall-E 3 only returns one image per request, so variants apply to the aspect ratio models
+        self.variants = variants
         self.aspect_ratio_view = None
         self.image_path = None
         self.interaction_completed = False
@@ -36,6 +40,10 @@ class DrawButtons(discord.ui.View):
             self.aspect_ratio_view = AspectRatioView(self, model="replicate")
         await interaction.response.edit_message(content="Select the aspect ratio for Replicate:", view=self.aspect_ratio_view)
 
+    @discord.ui.button(label="Compare All", style=discord.ButtonStyle.primary)
+    async def compare_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.generate_comparison(interaction)
+
     @discord.ui.button(label="Cancel", style=discord.ButtonStyle.danger)
     async def cancel_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.edit_message(content="Image generation canceled.", view=None)
@@ -51,22 +59,30 @@ class DrawButtons(discord.ui.View):
         self.stop()
 
     async def generate_dalle_image(self, interaction):
-        await self.generate_image(interaction, "Dall-E 3", image_generation.generate_image_dalle)
+        await self.generate_image(interaction, "dalle")
 
     async def generate_sd_image(self, interaction, aspect_ratio):
-        await self.generate_image(interaction, "Stable Diffusion 3", image_generation.generate_image_sd, aspect_ratio)
+        await self.generate_image(interaction, "sd", aspect_ratio)
 
     async def generate_replicate_image(self, interaction, aspect_ratio):
-        await self.generate_image(interaction, "Replicate", image_generation.generate_image_replicate, aspect_ratio)
+        await self.generate_image(interaction, "replicate", aspect_ratio)
 
-    async def generate_image(self, interaction, model_name, generate_function, aspect_ratio=None):
+    async def generate_image(self, interaction, model, aspect_ratio=None):
+        model_name = image_generation.IMAGE_PROVIDERS[model][0]
+        note = ""
+        if model == "dalle" and self.variants > 1:
+            note = f"{model_name} makes one image per request, so you get one image instead of {self.variants} variants."
+        # Waiting for an image worker and the provider can outlast the view's timeout, which would otherwise
+        # overwrite the progress message
+        self.interaction_completed = True
+        self.stop()
         try:
-            await interaction.response.edit_message(content=f"Generating image with {model_name}...", view=None)
+            await interaction.response.edit_message(content=f"Generating image with {model_name}... {note}".strip(), view=None)
             
-            if aspect_ratio:
-                result = await generate_function(self.prompt, aspect_ratio)
-            else:
-                result = await generate_function(self.prompt)
+            provider, result = await queue_manager.run_in_lane("image", interaction, image_generation.generate_image,
+                                                               model, self.prompt, aspect_ratio or "1:1", command="draw")
+            if provider != model:
+                model_name = f"{image_generation.IMAGE_PROVIDERS[provider][0]} (instead of {model_name})"
             
             logger.debug(f"Result from {model_name}: {result}")
             
@@ -74,8 +90,6 @@ class DrawButtons(discord.ui.View):
                 # This is an error message
                 logger.error(f"Error in {model_name}: {result}")
                 await interaction.edit_original_response(content=f"> **Error in {model_name}: {result}**", view=None)
-                self.interaction_completed = True
-                self.stop()
             else:
                 # This is a tuple containing image_data and image_path
                 image_data, self.image_path = result
@@ -84,20 +98,41 @@ class DrawButtons(discord.ui.View):
                 embed.description = f"> **Model: {model_name}**"
                 if aspect_ratio:
                     embed.description += f"\n> **Aspect Ratio: {aspect_ratio}**"
+                if note:
+                    embed.description += f"\n> {note}"
                 embed.set_image(url="attachment://image.png")
                 
-                view = GenerateVideoView(self.image_path)
+                view = GenerateVideoView(image_data)
                 
                 await interaction.edit_original_response(content=None, attachments=[file], embed=embed, view=view)
-                self.interaction_completed = True
-                self.stop()
         except ContentModerationError as e:
             logger.error(f"Content moderation error in {model_name}: {str(e)}")
             await interaction.edit_original_response(content=f"> **Content Moderation Error: {str(e)}**", view=None)
-            self.interaction_completed = True
-            self.stop()
         except Exception as e:
             logger.error(f"Unexpected error in generate_{model_name.lower().replace(' ', '_')}_image: {str(e)}")
             await interaction.edit_original_response(content=f"> **Error: An unexpected error occurred while generating the image with {model_name}.**", view=None)
-            self.interaction_completed = True
-            self.stop()
\ No newline at end of file
+
+    async def generate_comparison(self, interaction, aspect_ratio="1:1"):
+        # The comparison can outlast the view's timeout, which would otherwise overwrite the progress message
+        self.interaction_completed = True
+        self.stop()
+        try:
+            await interaction.response.edit_message(content="Generating image with every model...", view=None)
+
+            results, errors = await queue_manager.run_in_lane("image", interaction, image_generation.generate_comparison,
+                                                              self.prompt, aspect_ratio, command="draw")
+            for model_name, error in errors.items():
+                logger.error(f"Error in {model_name} during comparison: {error}")
+
+            if not results:
+                await interaction.edit_original_response(content="> **Error: None of the models returned an image.**", view=None)
+            else:
+                grid_data = await compose_grid([image_data for _, image_data in results], [model_name for model_name, _ in results])
+                file = discord.File(io.BytesIO(grid_data), filename="comparison.png")
+                embed = discord.Embed(title=f"> **{self.prompt}**")
+                embed.description = "\n".join(f"> **{model_name}: {error}**" for model_name, error in errors.items()) or None
+                embed.set_image(url="attachment://comparison.png")
+                await interaction.edit_original_response(content=None, attachments=[file], embed=embed, view=None)
+        except Exception as e:
+            logger.error(f"Unexpected error in generate_comparison: {str(e)}")
+            await interaction.edit_original_response(content="> **Error: An unexpected error occurred while comparing models.**", view=None)
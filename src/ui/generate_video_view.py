@@ -1,24 +1,59 @@
+import io
 import discord
 from src import log
 from src.art import video_generation
 
 logger = log.setup_logger(__name__)
 
+async def send_video(interaction: discord.Interaction, image_data):
+    # Returns True once the video has been delivered
+    video_data = await video_generation.image_to_video(image_data)
+    if isinstance(video_data, str):
+        # This is an error message
+        await interaction.followup.send(content=f"> **Error: {video_data}**")
+        return False
+    file = discord.File(io.BytesIO(video_data), filename="video.mp4")
+    await interaction.followup.send(content="Here's your generated video:", file=file)
+    return True
+
 class GenerateVideoView(discord.ui.View):
-    def __init__(self, image_path):
+    def __init__(self, image_data):
         super().__init__()
-        self.image_path = image_path
+        self.image_data = image_data
 
     @discord.ui.button(label="Generate Video", style=discord.ButtonStyle.success)
     async def generate_video_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer(thinking=True)
         try:
-            video_path = await video_generation.image_to_video(self.image_path)
-            file = discord.File(video_path, filename="video.mp4")
-            await interaction.followup.send(content="Here's your generated video:", file=file)
-            
+            if not await send_video(interaction, self.image_data):
+                return
+
             self.clear_items()
             await interaction.message.edit(view=self)
         except Exception as e:
             logger.exception(f"Error in generate_video_button: {str(e)}")
-            await interaction.followup.send(content="An error occurred while generating the video.")
\ No newline at end of file
+            await interaction.followup.send(content="An error occurred while generating the video.")
+
+class VariantVideoView(discord.ui.View):
+    # One numbered "Generate Video" button per variant in a grid
+    def __init__(self, variants):
+        super().__init__()
+        self.variants = variants
+        for number in variants:
+            button = discord.ui.Button(label=f"Video {number}", style=discord.ButtonStyle.success)
+            button.callback = self.make_callback(button, number)
+            self.add_item(button)
+
+    def make_callback(self, button, number):
+        async def callback(interaction: discord.Interaction):
+            await interaction.response.defer(thinking=True)
+            try:
+                if not await send_video(interaction, self.variants[number]):
+                    return
+
+                button.disabled = True
+                await interaction.message.edit(view=self)
+            except Exception as e:
+                logger.exception(f"Error generating video for variant {number}: {str(e)}")
+                await interaction.followup.send(content="An error occurred while generating the video.")
+        return callback